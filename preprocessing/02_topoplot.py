@@ -4,149 +4,82 @@
 
 import os
 import mne
-import multiprocessing
-from mne.parallel import parallel_func
-from mne.preprocessing import ICA
-from autoreject import AutoReject
-import collections
-from datetime import datetime
-import matplotlib.pyplot as plt
 import matplotlib
 matplotlib.use('Agg')
-import re
+import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 import glob
-import time
 
 # ------------------------------------------------------------------------------
 # prepare directories
 # ------------------------------------------------------------------------------
 
-# current dir
-current_pwd = os.path.dirname(os.path.realpath(__file__))
-
-# bad channels input directory
-bad_channel_inputdir = current_pwd + '/input/bad_channels/'
+# same directories as the preprocessing, see nogo_erp/config.py
+from nogo_erp import config
+from nogo_erp.grand_average import build_store, grand_average, read_store
+from nogo_erp.topomap import TopomapRenderer, time_slices, plot_topomap_grid, save_topomaps
 
-# ICA solutions input directory
-ica_inputdir = current_pwd + '/input/ica_solutions/'
-
-# temp data directories
-cropped_data_outputdir = current_pwd + '/tmp/cropped/'
-filtered_data_outputdir = current_pwd + '/tmp/filtered/'
-cleaned_data_outputdir = current_pwd + '/tmp/cleaned/'
-epoched_data_outputdir = current_pwd + '/tmp/epoched/'
-evoked_data_outputdir = current_pwd + '/tmp/evoked/'
-
-# results directories
-log_outputdir = current_pwd + '/output/logs/'
-averaged_data_outputdir = current_pwd + '/output/data/'
-plot_outputdir = current_pwd + '/output/plots/'
+evoked_data_outputdir = config.evoked_data_outputdir
+plot_outputdir = config.plot_outputdir
 
 # ------------------------------------------------------------------------------
 # prepare data
 # ------------------------------------------------------------------------------
 
-def cm2inch(*tupl):
-    inch = 2.54
-    if isinstance(tupl[0], tuple):
-        return tuple(i/inch for i in tupl[0])
-    else:
-        return tuple(i/inch for i in tupl)
-
-# list all evoked files from EEG preprocessing
-evoked_files_con = glob.glob(evoked_data_outputdir + 'KON*.fif')
-evoked_files_pat = glob.glob(evoked_data_outputdir + 'RPK*.fif')
+# grand averages are kept up to date by the preprocessing as each participant
+# is saved, the store is only built from the evoked files if it is missing,
+# e.g. for evoked files from before it existed
+if not os.path.isfile(config.grand_average_file):
+    build_store(glob.glob(evoked_data_outputdir + '*_nogocorr-ave.fif'), 'nogocorr')
 
-# include only files matching 'nogocorr'
-nogocorr = re.compile('.*nogocorr')
-evoked_files_con = list(filter(nogocorr.match, evoked_files_con))
-evoked_files_pat = list(filter(nogocorr.match, evoked_files_pat))
+store = read_store()
 
-con = []
-pat = []
+# channel positions from the montage used in preprocessing
+info = mne.create_info([str(ch) for ch in store['ch_names']], float(store['sfreq']), 'eeg')
+info.set_montage(mne.channels.read_custom_montage(config.montage_file))
 
-for files in evoked_files_con:
-    file = files
-    con.append(mne.read_evokeds(file, condition = 'nogocorr', proj = True, verbose = None))
+# average, channels x times in V
+grand_average_con, se_con, n_con = grand_average('KON', 'nogocorr', store = store)
+grand_average_pat, se_pat, n_pat = grand_average('RPK', 'nogocorr', store = store)
+times = store['times']
 
-for files in evoked_files_pat:
-    file = files
-    pat.append(mne.read_evokeds(file, condition = 'nogocorr', proj = True, verbose = None))
+# select channels for marking, the frontocentral ROI
+frontal_channels = config.roi_channels
 
-# average
-grand_average_con = mne.grand_average(con)
-grand_average_pat = mne.grand_average(pat)
+# the interpolation to the image grid is computed once and used for all maps
+renderer = TopomapRenderer(info, res = 32, mask_channels = frontal_channels)
 
-# select channels for marking
-frontal_channels = 19, 11, 4, 117, 12, 5, 111, 6, 105
+# ------------------------------------------------------------------------------
+# N2 and P3 plots
+# ------------------------------------------------------------------------------
 
-# set plot arguments
-mask = np.zeros_like(grand_average_con.data, dtype = bool)
-mask_params = dict(marker = 'o', markerfacecolor = 'w', markeredgecolor = 'k', linewidth = 0, markersize = 4)
-mask[[frontal_channels], :] = True
+# N2 at 290 ms and P3 at 450 ms, one file per group and component
+n2_vlim = (-3, 3)
+p3_vlim = (-9, 9)
 
-fig, ax = plt.subplots(2, 13, figsize = (cm2inch(24, 6)))
+data = time_slices([grand_average_con, grand_average_pat], times, [0.290, 0.450])
+fnames = [plot_outputdir + 'con_topo_n2_290.svg', plot_outputdir + 'con_topo_p3_400.svg',
+          plot_outputdir + 'pat_topo_n2_290.svg', plot_outputdir + 'pat_topo_p3_400.svg']
 
-# ------------------------------------------------------------------------------
-# N2 plot
-# ------------------------------------------------------------------------------
+save_topomaps(renderer, data, fnames, [n2_vlim, p3_vlim, n2_vlim, p3_vlim])
 
-times = (0.290)
-vmin = -3
-vmax = 3
-
-# kwargs
-kwargs = dict(times = times,
-              res = 32,
-              cmap = 'Spectral_r',
-              vmin = vmin,
-              vmax = vmax,
-              contours = 6,
-              extrapolate = 'box',
-              sphere = None,
-              mask = mask,
-              sensors = False,
-              time_unit = 's',
-              colorbar = True)
-
-con_topo = grand_average_con.plot_topomap(**kwargs)
-pat_topo = grand_average_pat.plot_topomap(**kwargs)
-
-con_topo.savefig(plot_outputdir + 'con_topo_n2_290.svg', dpi = 300, bbox_inches = 'tight',
-    pad_inches = 0)
-
-pat_topo.savefig(plot_outputdir + 'pat_topo_n2_290.svg', dpi = 300, bbox_inches = 'tight',
-    pad_inches = 0)
+# and the same four maps in one figure, groups in rows
+fig = plot_topomap_grid(renderer, data, 2, 2, [n2_vlim, p3_vlim],
+                        row_labels = ['Controls', 'Patients'], col_labels = ['N2, 290 ms', 'P3, 450 ms'])
+fig.savefig(plot_outputdir + 'topo_n2_p3.svg', dpi = 300, bbox_inches = 'tight', pad_inches = 0)
+plt.close(fig)
 
 # ------------------------------------------------------------------------------
-# P3 plot
+# time series
 # ------------------------------------------------------------------------------
 
-times = (0.450)
-vmin = -9
-vmax = 9
-
-# kwargs
-kwargs = dict(times = times,
-              res = 32,
-              cmap = 'Spectral_r',
-              vmin = vmin,
-              vmax = vmax,
-              contours = 6,
-              extrapolate = 'box',
-              sphere = None,
-              mask = mask,
-              sensors = False,
-              time_unit = 's',
-              colorbar = True)
-
-con_topo = grand_average_con.plot_topomap(**kwargs)
-pat_topo = grand_average_pat.plot_topomap(**kwargs)
-
-con_topo.savefig(plot_outputdir + 'con_topo_p3_400.svg', dpi = 300, bbox_inches = 'tight',
-    pad_inches = 0)
-
-pat_topo.savefig(plot_outputdir + 'pat_topo_p3_400.svg', dpi = 300, bbox_inches = 'tight',
-    pad_inches = 0)
+# every 50 ms from 0 to 750 ms, for controls, patients and the difference
+series_times = np.round(np.arange(0, 0.751, 0.05), 3)
+difference = grand_average_pat - grand_average_con
+
+data = time_slices([grand_average_con, grand_average_pat, difference], times, series_times)
+fig = plot_topomap_grid(renderer, data, 3, len(series_times), p3_vlim,
+                        row_labels = ['Controls', 'Patients', 'Difference'],
+                        col_labels = [str(int(t * 1e3)) + ' ms' for t in series_times])
+fig.savefig(plot_outputdir + 'topo_time_series.svg', dpi = 300, bbox_inches = 'tight', pad_inches = 0)
+plt.close(fig)
@@ -0,0 +1,19 @@
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+# same directories and parameters as the preprocessing, see nogo_erp/config.py
+from nogo_erp import config
+from nogo_erp.reliability import run_reliability
+
+# ------------------------------------------------------------------------------
+# split-half reliability
+# ------------------------------------------------------------------------------
+
+# Spearman-Brown corrected split-half reliability of the N2 and P3 features
+# over config.reliability_splits random splits of the single NoGo trials,
+# and of the odd/even split, written to output/data/reliability.csv
+reliability = run_reliability()
+
+print('Split-half reliability,', config.reliability_splits, 'splits, seed', config.reliability_seed)
+print(reliability.to_string(index = False))
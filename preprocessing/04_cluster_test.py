@@ -0,0 +1,44 @@
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+
+# same directories and parameters as the preprocessing, see nogo_erp/config.py
+from nogo_erp import config
+from nogo_erp.cluster_test import run_cluster_test
+
+# ------------------------------------------------------------------------------
+# cluster permutation test
+# ------------------------------------------------------------------------------
+
+# controls against patients on all channels and times after stimulus onset,
+# the clusters are written to output/data/cluster_test.csv
+table, t, labels, p_values, info, times = run_cluster_test()
+
+print('Cluster permutation test,', config.cluster_permutations, 'permutations, seed', config.cluster_seed)
+print(table.drop(columns = 'channels').to_string(index = False))
+
+# ------------------------------------------------------------------------------
+# plot
+# ------------------------------------------------------------------------------
+
+# t values of all channels over time, significant clusters outlined
+significant = np.isin(labels, np.flatnonzero(p_values < 0.05))
+vlim = np.abs(t).max()
+
+fig, ax = plt.subplots(figsize = (8, 6))
+image = ax.imshow(t, aspect = 'auto', origin = 'lower', cmap = 'RdBu_r', vmin = -vlim, vmax = vlim,
+                  extent = (times[0] * 1e3, times[-1] * 1e3, 0, len(info['ch_names'])))
+if significant.any():
+    ax.contour(times * 1e3, np.arange(len(info['ch_names'])) + 0.5, significant, levels = [0.5],
+               colors = 'k', linewidths = 0.8)
+ax.set_xlabel('Time (ms)')
+ax.set_ylabel('Channel')
+ax.set_title(config.cluster_groups[0] + ' - ' + config.cluster_groups[1] + ', ' + config.cluster_condition)
+fig.colorbar(image, ax = ax, label = 't')
+fig.savefig(config.plot_outputdir + 'cluster_test.svg', bbox_inches = 'tight')
+plt.close(fig)
@@ -0,0 +1,113 @@
+# ==============================================================================
+# Export format benchmark
+#
+# Compares write time, file size and read time of the single-trial export
+# formats in nogo_erp/export.py (csv, parquet, npy) on synthetic epochs shaped like
+# our data: 128 channels, -0.2 to 0.8 s at 500 Hz. The epochs are written with
+# export_conditions(), as the save stage writes <ID>_conditions_raw.
+#
+# Usage: python3 benchmarks/export_formats.py --epochs 50 --repeats 3
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+import argparse
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from nogo_erp.export import export_formats, export_extensions, export_conditions, read_erp_array
+
+# ------------------------------------------------------------------------------
+# synthetic data
+# ------------------------------------------------------------------------------
+
+def make_epochs(n_epochs, n_channels, sfreq, tmin, tmax, seed = 2020):
+
+    # epochs x channels x times in V, with the times in s, channel names,
+    # and the condition and epoch number of each epoch, as save_data passes
+    # them to export_conditions()
+    rng = np.random.RandomState(seed)
+    n_times = int(round((tmax - tmin) * sfreq)) + 1
+    epochs = {
+     'data': rng.randn(n_epochs, n_channels, n_times) * 10e-6,
+     'times': tmin + np.arange(n_times) / sfreq,
+     'ch_names': ['E' + str(i + 1) for i in range(n_channels)],
+     'conditions': np.array(['gocorr', 'nogocorr'])[np.arange(n_epochs) % 2],
+     'epochs': np.arange(n_epochs)
+    }
+    return(epochs)
+
+# ------------------------------------------------------------------------------
+# readers, each reads everything the R side would use
+# ------------------------------------------------------------------------------
+
+def read_export(fname, export_format):
+    if export_format == 'csv':
+        return(pd.read_csv(fname + '.csv').shape)
+    elif export_format == 'parquet':
+        return(pd.read_parquet(fname + '.parquet').shape)
+    else:
+        data, sidecar = read_erp_array(fname)
+        return(np.asarray(data).shape)
+
+# ------------------------------------------------------------------------------
+# run benchmark
+# ------------------------------------------------------------------------------
+
+def run_benchmark(epochs, repeats, formats):
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for export_format in formats:
+            fname = os.path.join(tmpdir, 'BENCH_conditions_raw')
+            write_times = []
+            read_times = []
+
+            for repeat in range(repeats):
+                start = time.perf_counter()
+                export_conditions(epochs['data'], epochs['times'], epochs['ch_names'], epochs['conditions'],
+                                  fname, export_format, epochs = epochs['epochs'])
+                write_times.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                read_export(fname, export_format)
+                read_times.append(time.perf_counter() - start)
+
+            size = sum(os.path.getsize(fname + ext) for ext in export_extensions[export_format])
+
+            results.append({
+             'format': export_format,
+             'write_seconds': round(min(write_times), 4),
+             'read_seconds': round(min(read_times), 4),
+             'size_mb': round(size / 1e6, 2)
+            })
+
+    results = pd.DataFrame(results)
+    for column in ['write_seconds', 'read_seconds', 'size_mb']:
+        results[column + '_vs_csv'] = round(results[column] / results.loc[results['format'] == 'csv', column].values[0], 3) if 'csv' in formats else np.nan
+    return(results)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark single-trial export formats.')
+    parser.add_argument('--epochs', type = int, default = 50, help = 'number of epochs (default: 50)')
+    parser.add_argument('--channels', type = int, default = 128, help = 'number of channels (default: 128)')
+    parser.add_argument('--sfreq', type = float, default = 500., help = 'sampling rate in Hz (default: 500)')
+    parser.add_argument('--repeats', type = int, default = 3, help = 'repeats per format, the fastest is reported (default: 3)')
+    parser.add_argument('--formats', nargs = '+', default = export_formats, choices = export_formats)
+    parser.add_argument('--output', default = None, help = 'optional csv file to save the results to')
+    args = parser.parse_args()
+
+    epochs = make_epochs(args.epochs, args.channels, args.sfreq, -0.2, 0.8)
+
+    print('\nBenchmarking', args.epochs, 'epochs x', args.channels, 'channels x', len(epochs['times']), 'time points\n')
+    results = run_benchmark(epochs, args.repeats, args.formats)
+    print(results.to_string(index = False))
+
+    if args.output is not None:
+        results.to_csv(args.output, index = False)
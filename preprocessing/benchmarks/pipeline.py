@@ -0,0 +1,287 @@
+# ==============================================================================
+# Pipeline benchmark
+#
+# Runs the pipeline on synthetic data (see synthetic_data.py), timing
+# each stage function on recordings of increasing length, and the whole
+# batch (run_batch/run_preprocess) for a range of core counts. Results are
+# compared against a stored baseline, so that a slower stage shows up as a
+# regression.
+#
+# Usage:
+#   python3 benchmarks/pipeline.py --scales 0.25 0.5 1 --cores 1 2 4 --save-baseline
+#   python3 benchmarks/pipeline.py --scales 0.25 0.5 1 --cores 1 2 4
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+import argparse
+import json
+import multiprocessing
+import platform
+import shutil
+import tempfile
+import time
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import mne
+import pandas as pd
+
+benchmark_dir = os.path.dirname(os.path.realpath(__file__))
+pipeline_dir = os.path.dirname(benchmark_dir)
+sys.path.insert(0, pipeline_dir)
+sys.path.insert(0, benchmark_dir)
+from synthetic_data import make_dataset, sfreq
+from nogo_erp import config, stages
+from nogo_erp.pipeline import run_batch
+from nogo_erp.profiling import profile_stage
+
+# ------------------------------------------------------------------------------
+# configure the pipeline
+# ------------------------------------------------------------------------------
+
+def configure_pipeline(root, autoreject_cv = None):
+
+    # point every input/tmp/output directory at root and start from empty
+    # tmp/ and output/ directories, nothing is cached or reused between runs
+    config.set_root(root)
+    for folder in ['tmp', 'output']:
+        shutil.rmtree(os.path.join(root, folder), ignore_errors = True)
+    for name, path in config.paths.items():
+        if name.endswith('outputdir'):
+            os.makedirs(getattr(config, name), exist_ok = True)
+
+    config.use_cache = False
+    config.save_checkpoints = False
+    config.reuse_autoreject_model = False
+    config.stage_profiler = None
+    config.overwrite_opts = True
+    if autoreject_cv is not None:
+        config.autoreject_cv = autoreject_cv
+
+# ------------------------------------------------------------------------------
+# stage benchmark
+# ------------------------------------------------------------------------------
+
+def run_stages(participant, njobs):
+
+    # the stage functions in order, each handing its data to the next one,
+    # returns one profile record per stage
+    profile_log = []
+
+    def save_stage(data):
+        stages.save_data(participant, data)
+        return(data)
+
+    stage_calls = [
+     ('prepare', lambda data: stages.prepare_data(participant)),
+     ('filter', lambda data: stages.filter_data(participant, data, njobs)),
+     ('ica', lambda data: stages.apply_ica(participant, data)),
+     ('epoch', lambda data: stages.epoch_data(participant, data)),
+     ('autoreject', lambda data: stages.autoreject_data(participant, njobs, config.ar_threshold,
+                                                        config.autoreject_cv, config.autoreject_random_state, data)),
+     ('save', save_stage),
+     ('features', lambda data: stages.feature_data(participant, data))
+    ]
+
+    data = None
+    for stage, call in stage_calls:
+        with profile_stage(stage, profile_log) as record:
+            data = call(data)
+            record['n_jobs'] = njobs if stage in ['filter', 'autoreject'] else 1
+    return(profile_log)
+
+def benchmark_stages(workdir, scales, repeats, njobs, autoreject_cv):
+    results = []
+    for scale in scales:
+        root = os.path.join(workdir, 'stages_' + str(scale))
+        files = make_dataset(root, num_participants = 1, scale = scale)
+        size_mb = os.path.getsize(os.path.join(root, 'input', 'data', files[0])) / 1e6
+
+        for repeat in range(repeats):
+            configure_pipeline(root, autoreject_cv)
+            raw = mne.io.read_raw_egi(os.path.join(root, 'input', 'data', files[0]), preload = False, verbose = False)
+            duration = raw.n_times / sfreq
+
+            for record in run_stages(files[0], njobs):
+                record.update({'scale': scale, 'repeat': repeat, 'recording_seconds': round(duration, 1), 'input_mb': round(size_mb, 1)})
+                results.append(record)
+
+    results = pd.DataFrame(results)
+
+    # fastest repeat per stage and size, and throughput in seconds of
+    # recording processed per second
+    results = results.sort_values('wall_time_in_seconds').groupby(['scale', 'stage'], sort = False).head(1)
+    results['recording_seconds_per_second'] = round(results['recording_seconds'] / results['wall_time_in_seconds'], 1)
+    stage_order = {stage: i for i, stage in enumerate(config.stages + ['save', 'features'])}
+    results['stage_order'] = results['stage'].map(stage_order)
+    results = results.sort_values(['scale', 'stage_order'])
+    return(results.drop(columns = ['repeat', 'stage_order']).reset_index(drop = True))
+
+# ------------------------------------------------------------------------------
+# pipeline benchmark
+# ------------------------------------------------------------------------------
+
+def benchmark_pipeline(workdir, cores, num_participants, scale, repeats, autoreject_cv):
+    root = os.path.join(workdir, 'pipeline')
+    files = make_dataset(root, num_participants = num_participants, scale = scale)
+
+    results = []
+    for num_cores in cores:
+        times = []
+        for repeat in range(repeats):
+            configure_pipeline(root, autoreject_cv)
+            config.parallel_cores = min(num_cores, num_participants)
+            config.total_cores = num_cores
+
+            start = time.perf_counter()
+            run_batch(files)
+            times.append(time.perf_counter() - start)
+
+        results.append({'cores': num_cores,
+                        'participants': num_participants,
+                        'scale': scale,
+                        'wall_time_in_seconds': round(min(times), 3)})
+
+    # speedup and parallel efficiency relative to the smallest core count
+    results = pd.DataFrame(results)
+    reference = results.iloc[0]
+    results['speedup'] = round(reference['wall_time_in_seconds'] / results['wall_time_in_seconds'], 2)
+    results['efficiency'] = round(results['speedup'] / (results['cores'] / reference['cores']), 2)
+    results['participants_per_minute'] = round(num_participants / (results['wall_time_in_seconds'] / 60), 2)
+    return(results)
+
+# ------------------------------------------------------------------------------
+# plots
+# ------------------------------------------------------------------------------
+
+def plot_results(stage_results, pipeline_results, fname):
+    fig, axes = plt.subplots(1, 2, figsize = (12, 4.5))
+
+    for stage, df in stage_results.groupby('stage', sort = False):
+        axes[0].plot(df['recording_seconds'], df['wall_time_in_seconds'], marker = 'o', label = stage)
+    axes[0].set_xlabel('Recording length (s)')
+    axes[0].set_ylabel('Wall time (s)')
+    axes[0].set_title('Stage time by recording length')
+    axes[0].legend()
+
+    if pipeline_results is not None:
+        axes[1].plot(pipeline_results['cores'], pipeline_results['speedup'], marker = 'o', label = 'measured')
+        axes[1].plot(pipeline_results['cores'], pipeline_results['cores'] / pipeline_results['cores'].iloc[0], linestyle = '--', color = 'grey', label = 'linear')
+        axes[1].set_xlabel('Cores')
+        axes[1].set_ylabel('Speedup')
+        axes[1].set_title('Batch scaling')
+        axes[1].legend()
+
+    fig.tight_layout()
+    fig.savefig(fname)
+    plt.close(fig)
+
+# ------------------------------------------------------------------------------
+# baseline
+# ------------------------------------------------------------------------------
+
+def machine_info():
+    return({'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': multiprocessing.cpu_count(),
+            'python': platform.python_version(),
+            'mne': mne.__version__})
+
+def timings(stage_results, pipeline_results):
+
+    # flat {name: seconds} dictionary, the unit compared against the baseline
+    result = {}
+    for _, row in stage_results.iterrows():
+        result['stage/' + row['stage'] + '/scale_' + str(row['scale'])] = float(row['wall_time_in_seconds'])
+    if pipeline_results is not None:
+        for _, row in pipeline_results.iterrows():
+            result['pipeline/cores_' + str(int(row['cores']))] = float(row['wall_time_in_seconds'])
+    return(result)
+
+def compare_baseline(current, baseline, tolerance):
+
+    # ratio of the current to the baseline time, a regression is anything
+    # slower than the baseline by more than the tolerance
+    rows = []
+    for name, seconds in current.items():
+        if name not in baseline['timings']:
+            continue
+        ratio = seconds / baseline['timings'][name] if baseline['timings'][name] > 0 else 1.
+        rows.append({'benchmark': name,
+                     'baseline_seconds': baseline['timings'][name],
+                     'current_seconds': seconds,
+                     'ratio': round(ratio, 2),
+                     'regression': ratio > 1 + tolerance})
+    return(pd.DataFrame(rows))
+
+# ------------------------------------------------------------------------------
+# run benchmark
+# ------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark 01_preprocess.py on synthetic data.')
+    parser.add_argument('--scales', type = float, nargs = '+', default = [0.25, 0.5, 1.],
+                        help = 'recording lengths for the stage benchmark, as fractions of a full session (default: 0.25 0.5 1)')
+    parser.add_argument('--stage-jobs', type = int, default = 1, help = 'n_jobs for the filter and AR stages in the stage benchmark (default: 1)')
+    parser.add_argument('--cores', type = int, nargs = '+', default = [1, 2, 4], help = 'core counts for the batch benchmark (default: 1 2 4)')
+    parser.add_argument('--participants', type = int, default = 4, help = 'participants in the batch benchmark (default: 4)')
+    parser.add_argument('--pipeline-scale', type = float, default = 0.5, help = 'recording length in the batch benchmark (default: 0.5)')
+    parser.add_argument('--skip-pipeline', action = 'store_true', help = 'only run the stage benchmark')
+    parser.add_argument('--repeats', type = int, default = 1, help = 'repeats per measurement, the fastest is kept (default: 1)')
+    parser.add_argument('--autoreject-cv', type = int, default = None, help = 'override the AR CV folds, e.g. to speed up short recordings')
+    parser.add_argument('--workdir', default = None, help = 'directory for the synthetic data (default: a temporary directory)')
+    parser.add_argument('--output', default = os.path.join(benchmark_dir, 'results'), help = 'directory for the result tables and plot')
+    parser.add_argument('--baseline', default = os.path.join(benchmark_dir, 'baseline.json'), help = 'baseline file to compare against or save to')
+    parser.add_argument('--save-baseline', action = 'store_true', help = 'save the results as the new baseline')
+    parser.add_argument('--tolerance', type = float, default = 0.25, help = 'allowed slowdown before a benchmark counts as a regression (default: 0.25)')
+    args = parser.parse_args()
+
+    mne.set_log_level('CRITICAL')
+    os.makedirs(args.output, exist_ok = True)
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix = 'nogo_benchmark_')
+
+    print('\nStage benchmark, scales', args.scales)
+    stage_results = benchmark_stages(workdir, args.scales, args.repeats, args.stage_jobs, args.autoreject_cv)
+    stage_results.to_csv(os.path.join(args.output, 'stage_benchmark.csv'), index = False)
+    print(stage_results[['scale', 'stage', 'wall_time_in_seconds', 'cpu_time_in_seconds', 'peak_rss_in_mb',
+                         'recording_seconds_per_second']].to_string(index = False))
+
+    pipeline_results = None
+    if not args.skip_pipeline:
+        print('\nBatch benchmark,', args.participants, 'participants, cores', args.cores)
+        pipeline_results = benchmark_pipeline(workdir, args.cores, args.participants, args.pipeline_scale,
+                                              args.repeats, args.autoreject_cv)
+        pipeline_results.to_csv(os.path.join(args.output, 'pipeline_benchmark.csv'), index = False)
+        print(pipeline_results.to_string(index = False))
+
+    plot_results(stage_results, pipeline_results, os.path.join(args.output, 'benchmark.svg'))
+
+    if args.workdir is None:
+        shutil.rmtree(workdir, ignore_errors = True)
+
+    # save or compare against the baseline
+    current = timings(stage_results, pipeline_results)
+    regressions = False
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': machine_info(), 'settings': vars(args), 'timings': current}, f, indent = 1)
+        print('\nSaved baseline to', args.baseline)
+
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline['machine'] != machine_info():
+            print('\nWarning: the baseline was recorded on a different machine or software versions')
+        comparison = compare_baseline(current, baseline, args.tolerance)
+        comparison.to_csv(os.path.join(args.output, 'baseline_comparison.csv'), index = False)
+        print('\nCompared to baseline:\n')
+        print(comparison.to_string(index = False))
+        regressions = bool(comparison['regression'].any()) if len(comparison) > 0 else False
+
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,199 @@
+# ==============================================================================
+# Synthetic Go/NoGo EEG data
+#
+# Writes a complete input/ directory for 01_preprocess.py without the real
+# recordings: GSN-HydroCel-129 recordings in EGI simple binary format with
+# a Go/NoGo trigger sequence, bad channel files, ICA solutions and the
+# montage. Used by the pipeline benchmark.
+#
+# Usage: python3 benchmarks/synthetic_data.py <dir> --participants 4 --scale 1
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import os
+import argparse
+import mne
+import numpy as np
+
+# ------------------------------------------------------------------------------
+# parameters
+# ------------------------------------------------------------------------------
+
+# a full session, the trial counts are scaled by the scale argument
+num_go_trials = 274
+num_nogo_trials = 52
+sfreq = 1000
+num_channels = 129 # E129 is the (silent) reference
+trial_duration = 1.2 # stimulus onset asynchrony in s
+
+# EGI event codes, four characters each, go/nogo/response/pause
+event_codes = ['go  ', 'nogo', 'resp', 'paus']
+
+# frontocentral channels carrying the synthetic N2/P3, and channels that may
+# be marked bad (never ROI channels)
+erp_channels = ['E20', 'E12', 'E5', 'E118', 'E13', 'E6', 'E112', 'E7', 'E106', 'E11', 'E4', 'E19']
+bad_channel_candidates = ['E17', 'E44', 'E49', 'E56', 'E63', 'E99', 'E107', 'E113', 'E119', 'E125']
+
+# ------------------------------------------------------------------------------
+# EGI simple binary writer
+# ------------------------------------------------------------------------------
+
+def write_egi_raw(fname, data, events, codes, sfreq):
+
+    # unsegmented, version 4 (float32) file as read by mne.io.read_raw_egi,
+    # data is channels x samples in µV, events is events x samples of 0/1
+    n_channels, n_samples = data.shape
+    with open(fname, 'wb') as f:
+        np.array([4], '>i4').tofile(f)
+        np.array([2020, 5, 1, 10, 0, 0], '>i2').tofile(f) # recording date and time
+        np.array([0], '>i4').tofile(f) # milliseconds
+        np.array([sfreq, n_channels, 0, 0, 0], '>i2').tofile(f) # rate, channels, gain, bits, range
+        np.array([n_samples], '>i4').tofile(f)
+        np.array([len(codes)], '>i2').tofile(f)
+        for code in codes:
+            f.write(code.encode('ascii'))
+
+        # samples are stored one time point at a time, write in blocks to
+        # keep memory down for long recordings
+        for start in range(0, n_samples, 100000):
+            stop = min(start + 100000, n_samples)
+            np.vstack([data[:, start:stop], events[:, start:stop]]).T.astype('>f4').tofile(f)
+
+# ------------------------------------------------------------------------------
+# recording
+# ------------------------------------------------------------------------------
+
+def trial_sequence(rng, scale):
+
+    # go and nogo trials in random order, at least one of each
+    n_go = max(int(round(num_go_trials * scale)), 2)
+    n_nogo = max(int(round(num_nogo_trials * scale)), 1)
+    trials = np.array(['go'] * n_go + ['nogo'] * n_nogo)
+    rng.shuffle(trials)
+    return(trials)
+
+def make_recording(rng, scale):
+
+    # returns data (channels x samples, µV) and events (4 x samples), with
+    # responses to most go trials, commission errors on about a quarter of
+    # the nogo trials and some anticipatory responses, so that there are
+    # more responses than go trials as in the real data
+    trials = trial_sequence(rng, scale)
+    lead_in, lead_out = 5 * sfreq, 3 * sfreq
+    isi = int(trial_duration * sfreq)
+    n_samples = lead_in + len(trials) * isi + lead_out
+    times = np.arange(n_samples) / sfreq
+
+    # background, white noise plus a random walk and alpha with random topography
+    data = rng.standard_normal((num_channels, n_samples)).astype(np.float32) * 5
+    data += np.cumsum(rng.standard_normal((num_channels, n_samples)).astype(np.float32), axis = 1) * 0.05
+    data += (np.sin(2 * np.pi * 10 * times)[np.newaxis] * rng.rand(num_channels, 1) * 10).astype(np.float32)
+
+    # N2 and P3 over the frontocentral channels on nogo trials
+    erp_picks = [int(ch[1:]) - 1 for ch in erp_channels]
+    erp_times = np.arange(int(0.7 * sfreq)) / sfreq
+    n2 = -4 * np.exp(-((erp_times - 0.275) / 0.03) ** 2)
+    p3 = 8 * np.exp(-((erp_times - 0.45) / 0.08) ** 2)
+
+    # blinks, for the ICA to find
+    blink_topography = np.zeros(num_channels, dtype = np.float32)
+    blink_topography[[0, 7, 13, 14, 20, 21, 24, 31, 120, 124, 125, 127]] = 1
+    blink = np.hanning(int(0.3 * sfreq)).astype(np.float32) * 100
+
+    events = np.zeros((len(event_codes), n_samples), dtype = np.float32)
+    for i, trial in enumerate(trials):
+        onset = lead_in + i * isi
+        if trial == 'go':
+            events[0, onset] = 1
+            if rng.rand() < 0.97:
+                events[2, onset + rng.randint(300, 500)] = 1
+            if rng.rand() < 0.15:
+                events[2, onset + rng.randint(800, 1100)] = 1
+        else:
+            events[1, onset] = 1
+            data[np.ix_(erp_picks, np.arange(onset, onset + len(erp_times)))] += (n2 + p3).astype(np.float32)
+            if rng.rand() < 0.25:
+                events[2, onset + rng.randint(350, 550)] = 1
+        if rng.rand() < 0.1:
+            blink_onset = onset + rng.randint(600, 900)
+            data[:, blink_onset:blink_onset + len(blink)] += blink_topography[:, np.newaxis] * blink
+
+    events[3, n_samples - 2 * sfreq] = 1
+    data[-1] = 0
+    return(data, events)
+
+# ------------------------------------------------------------------------------
+# input files
+# ------------------------------------------------------------------------------
+
+def write_montage(fname):
+
+    # MNE's GSN-HydroCel-129 montage, with Cz named E129 as in our recordings
+    template = os.path.join(os.path.dirname(mne.__file__), 'channels', 'data', 'montages', 'GSN-HydroCel-129.sfp')
+    with open(template, 'r') as f:
+        lines = f.read().splitlines()
+    lines = ['E129' + line[2:] if line.startswith('Cz') else line for line in lines]
+    with open(fname, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def write_ica(raw_fname, ica_fname, montage_fname, bad_channels, seed):
+
+    # fitted the way the real solutions were, on interpolated 1-30 Hz data,
+    # with the first component (the blinks, usually) excluded
+    raw = mne.io.read_raw_egi(raw_fname, preload = True, verbose = False)
+    raw.set_montage(mne.channels.read_custom_montage(montage_fname))
+    raw.drop_channels(['E129'])
+    if len(bad_channels) > 0:
+        raw.info['bads'] = bad_channels
+        raw.interpolate_bads(reset_bads = True, verbose = False)
+    raw.filter(1, 30, verbose = False)
+    ica = mne.preprocessing.ICA(n_components = 15, random_state = seed, max_iter = 200, verbose = False)
+    ica.fit(raw, picks = 'eeg', decim = 5, verbose = False)
+    ica.exclude = [0]
+    ica.save(ica_fname)
+
+def participant_ids(num_participants):
+
+    # alternate between the two groups, as the topoplot script expects both
+    return([('KON' if i % 2 == 0 else 'RPK') + '%03d' % i for i in range(num_participants)])
+
+def make_dataset(root, num_participants = 2, scale = 1., seed = 2020, ica = True):
+
+    # writes root/input/{data,bad_channels,ica_solutions,montage}, returns
+    # the data file names
+    for folder in ['data', 'bad_channels', 'ica_solutions', 'montage']:
+        os.makedirs(os.path.join(root, 'input', folder), exist_ok = True)
+
+    montage_fname = os.path.join(root, 'input', 'montage', 'GSN-HydroCel-129.sfp')
+    write_montage(montage_fname)
+
+    files = []
+    for i, participantid in enumerate(participant_ids(num_participants)):
+        rng = np.random.RandomState(seed + i)
+        data, events = make_recording(rng, scale)
+        raw_fname = os.path.join(root, 'input', 'data', participantid + '_gng.raw')
+        write_egi_raw(raw_fname, data, events, event_codes, sfreq)
+
+        bad_channels = list(rng.choice(bad_channel_candidates, size = rng.randint(0, 3), replace = False))
+        with open(os.path.join(root, 'input', 'bad_channels', participantid + '_bad_channels'), 'w') as f:
+            f.write(''.join(ch + '\n' for ch in bad_channels))
+
+        if ica:
+            write_ica(raw_fname, os.path.join(root, 'input', 'ica_solutions', participantid + '_ica.fif'), montage_fname, bad_channels, seed + i)
+        files.append(os.path.basename(raw_fname))
+
+    return(files)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Write synthetic Go/NoGo input data for 01_preprocess.py.')
+    parser.add_argument('root', help = 'directory to write input/ to')
+    parser.add_argument('--participants', type = int, default = 2, help = 'number of participants (default: 2)')
+    parser.add_argument('--scale', type = float, default = 1., help = 'fraction of a full session of 274 go and 52 nogo trials (default: 1)')
+    parser.add_argument('--seed', type = int, default = 2020)
+    args = parser.parse_args()
+
+    files = make_dataset(args.root, args.participants, args.scale, args.seed)
+    print('Wrote', len(files), 'recordings to', os.path.join(args.root, 'input', 'data'))
@@ -0,0 +1,27 @@
+# ==============================================================================
+# Go/NoGo ERP preprocessing
+#
+# The stages of 01_preprocess.py as an importable package. Importing it is
+# cheap, MNE and the other heavy dependencies are only loaded by the
+# modules that need them:
+#
+#   config     parameters and directories
+#   events     event counting and trial classification
+#   stages     the preprocessing stages, prepare_data to feature_data
+#   ica_cleaning  ICA applied as one cached cleaning matrix
+#   cache      stage result cache
+#   scheduler  core budget shared between participants
+#   errors     participant errors and the failure manifest
+#   pipeline   run_preprocess, run_batch and run_single_stage
+#   executors  local, work queue and cluster backends of run_batch
+#   export     csv, parquet and npy writers
+#   epochs_store  memory-mapped cleaned epochs
+#   features   ROI amplitude and latency measures
+#   reliability  split-half reliability of the features
+#   cluster_test  cluster permutation test of the group difference
+#   grand_average  running group sums of the evoked data
+#   topomap    batched topomap interpolation and figures
+#   profiling  per-stage timing, memory and I/O
+#   runlog     cohort log writer and reader, session info logger
+#   cli        command line interface, also run by python -m nogo_erp
+# ==============================================================================
@@ -0,0 +1,9 @@
+# ==============================================================================
+# python -m nogo_erp, see cli.py
+# ==============================================================================
+
+import sys
+
+from .cli import main
+
+sys.exit(main())
@@ -0,0 +1,150 @@
+# ==============================================================================
+# Stage cache
+#
+# Content-addressed cache of stage results under tmp/cache/, keyed on the
+# input file and on the parameters and code of each stage and all stages
+# before it.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import os
+import collections
+import glob
+import hashlib
+import inspect
+import json
+
+from . import config
+from .config import file_splitter
+
+# ------------------------------------------------------------------------------
+# stage cache
+# ------------------------------------------------------------------------------
+
+# whether each stage produces raw or epoched data
+stage_data_types = {'prepare': 'raw', 
+                    'filter': 'raw', 
+                    'ica': 'raw', 
+                    'epoch': 'epo', 
+                    'autoreject': 'epo'}
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    paths = [path]
+    # some EGI recordings are directories rather than single files
+    if os.path.isdir(path):
+        paths = sorted(glob.glob(path + '/**/*', recursive = True))
+    for p in paths:
+        if os.path.isfile(p):
+            with open(p, 'rb') as f:
+                for chunk in iter(lambda: f.read(2**20), b''):
+                    sha.update(chunk)
+    return(sha.hexdigest())
+
+def input_file_hash(participant):
+    file = config.data_inputdir + participant
+    participantid = file_splitter(file)
+
+    # the raw recordings are large, so remember their hash for as long as
+    # size and modification time are unchanged, of every file inside for
+    # recordings that are directories, whose own stat does not change when
+    # a file in them is rewritten
+    paths = [file]
+    if os.path.isdir(file):
+        paths = [p for p in sorted(glob.glob(file + '/**/*', recursive = True)) if os.path.isfile(p)]
+    signature = ''
+    for p in paths:
+        stat = os.stat(p)
+        signature += os.path.relpath(p, file) + ' ' + str(stat.st_size) + ' ' + str(stat.st_mtime_ns) + ' '
+    signature = signature.rstrip(' ')
+    hash_file = config.cache_outputdir + participantid + '_input.sha256'
+
+    if os.path.isfile(hash_file):
+        with open(hash_file, 'r') as f:
+            cached_signature, cached_hash = f.read().rsplit(' ', 1)
+        if cached_signature == signature:
+            return(cached_hash)
+
+    input_hash = file_hash(file)
+    with open(hash_file, 'w') as f:
+        f.write(signature + ' ' + input_hash)
+    return(input_hash)
+
+def stage_keys(participant):
+    import autoreject
+    import mne
+    from . import ica_cleaning
+    from .events import classify_events
+    from .stages import find_last_event, prepare_data, filter_bands, decimation_factor, filter_data, apply_ica, epoch_data, autoreject_data
+
+    file = config.data_inputdir + participant
+    participantid = file_splitter(file)
+
+    with open(config.bad_channel_inputdir + participantid + '_bad_channels', 'r') as f:
+        bad_channels = [line.rstrip('\n') for line in f]
+
+    # everything each stage depends on, the stage code itself included
+    stage_params = {
+     'prepare': {'input': input_file_hash(participant), 
+                 'montage': file_hash(config.montage_file), 
+                 'code': inspect.getsource(prepare_data) + inspect.getsource(find_last_event)}, 
+     'filter': {'raw_highpass': config.raw_filter_highpass, 
+                'raw_lowpass': config.raw_filter_lowpass, 
+                'filter_method': config.filter_method, 
+                'filter_phase': config.filter_phase, 
+                'fir_window': config.fir_window, 
+                'fir_design': config.fir_design, 
+                'dual_band_filter': config.dual_band_filter, 
+                'bad_channels': bad_channels, 
+                'code': inspect.getsource(filter_data) + inspect.getsource(filter_bands)}, 
+     'ica': {'ica_solution': file_hash(config.ica_inputdir + participantid + '_ica.fif'), 
+             'ica_cleaning_matrix': config.ica_cleaning_matrix, 
+             'code': inspect.getsource(apply_ica) + inspect.getsource(ica_cleaning)}, 
+     'epoch': {'tmin': config.tmin, 
+               'tmax': config.tmax, 
+               'baseline': config.baseline, 
+               'event_rules': config.event_rules, 
+               'lazy_epoching': config.lazy_epoching, 
+               'decimate_epochs': config.decimate_epochs, 
+               'target_sfreq': config.target_sfreq, 
+               'code': inspect.getsource(epoch_data) + inspect.getsource(decimation_factor) + inspect.getsource(classify_events)}, 
+     'autoreject': {'autoreject_cv': config.autoreject_cv, 
+                    'autoreject_random_state': config.autoreject_random_state, 
+                    'autoreject_version': autoreject.__version__, 
+                    'reuse_autoreject_model': config.reuse_autoreject_model, 
+                    'autoreject_warm_start': config.autoreject_warm_start, 
+                    'code': inspect.getsource(autoreject_data)}
+    }
+
+    # chain the keys, so a change in one stage invalidates all stages after it
+    keys = collections.OrderedDict()
+    parent = mne.__version__
+    for stage in config.stages:
+        params = json.dumps(stage_params[stage], sort_keys = True)
+        parent = hashlib.sha256((parent + params).encode('utf-8')).hexdigest()[:16]
+        keys[stage] = parent
+    return(keys)
+
+def cache_file(participantid, stage, key):
+    return(config.cache_outputdir + participantid + '_' + stage + '_' + key + '-' + stage_data_types[stage] + '.fif')
+
+def read_cache(participantid, stage, key):
+    import mne
+
+    if stage_data_types[stage] == 'raw':
+        return(mne.io.read_raw_fif(cache_file(participantid, stage, key), preload = True))
+    return(mne.read_epochs(cache_file(participantid, stage, key), proj = True, preload = True))
+
+def write_cache(participantid, stage, key, data):
+
+    # drop results for this stage that were computed with other inputs
+    for old_file in glob.glob(config.cache_outputdir + participantid + '_' + stage + '_*.fif'):
+        os.remove(old_file)
+
+    if stage_data_types[stage] == 'raw':
+        data.save(cache_file(participantid, stage, key), fmt = 'double', overwrite = True)
+    else:
+        data.save(cache_file(participantid, stage, key), split_size = '2GB', fmt = 'double', overwrite = True)
@@ -0,0 +1,167 @@
+# ==============================================================================
+# Command line interface
+#
+# Parses the run parameters, lists the participants and runs the batch or
+# a single stage. MNE and everything else heavy is only imported once
+# there is something to run, so --dry-run returns right away.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+import argparse
+
+from . import config
+from .runlog import Logger
+
+# ------------------------------------------------------------------------------
+# session info
+# ------------------------------------------------------------------------------
+
+def session_info():
+    from sinfo import sinfo
+
+    # printed and saved to session_info.txt
+    logger = Logger(config.log_outputdir + 'session_info.txt')
+    sys.stdout = logger
+    try:
+        sinfo()
+    finally:
+        sys.stdout = logger.terminal
+        logger.close()
+
+# ------------------------------------------------------------------------------
+# arguments
+# ------------------------------------------------------------------------------
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(prog = 'nogo_erp', description = 'Preprocess Go/NoGo EEG data.')
+    parser.add_argument('--root', default = None,
+                        help = 'directory with input/, tmp/ and output/ (default: the preprocessing directory)')
+    parser.add_argument('--participants', nargs = '+', default = None, metavar = 'ID',
+                        help = 'only run these participants, e.g. KON001 RPK002 (default: all in input/data/)')
+    parser.add_argument('--stage', default = None, choices = config.stages + ['save'],
+                        help = 'only run this stage, on the checkpoints of an earlier run')
+    parser.add_argument('--dry-run', action = 'store_true', help = 'print the parameters and participants and exit')
+    parser.add_argument('--cores', type = int, default = config.parallel_cores, help = 'participants run in parallel (default: %(default)s)')
+    parser.add_argument('--total-cores', type = int, default = None, help = 'core budget shared with the inner n_jobs (default: --cores)')
+    parser.add_argument('--ar-threshold', type = int, default = config.ar_threshold, help = 'minimum correct nogo trials after AR (default: %(default)s)')
+    parser.add_argument('--ar-cv', type = int, default = config.autoreject_cv, help = 'AR CV folds (default: %(default)s)')
+    parser.add_argument('--ar-random-state', type = int, default = config.autoreject_random_state, help = 'AR random state (default: %(default)s)')
+    parser.add_argument('--export-format', default = config.export_format, choices = ['csv', 'parquet', 'npy'],
+                        help = 'format of the data in output/ (default: %(default)s)')
+    parser.add_argument('--checkpoints', action = 'store_true', help = 'save intermediate files under tmp/')
+    parser.add_argument('--no-cache', action = 'store_true', help = 'ignore and do not write the stage cache')
+    parser.add_argument('--profiler', default = config.stage_profiler, choices = ['cprofile', 'pyinstrument'],
+                        help = 'write a profile of every stage to output/logs/profiles/')
+    parser.add_argument('--executor', default = config.executor, choices = ['local', 'queue', 'cluster'],
+                        help = 'run participants on this machine, from a work queue under tmp/queue/ or as cluster jobs (default: %(default)s)')
+    parser.add_argument('--worker', action = 'store_true',
+                        help = 'join the work queue of a queue or cluster run and work until it is empty')
+    parser.add_argument('--rerun-failed', action = 'store_true',
+                        help = 'only run the participants in output/logs/failed_participants.json')
+    parser.add_argument('--max-attempts', type = int, default = config.max_attempts,
+                        help = 'runs of a participant that failed with an error worth retrying (default: %(default)s)')
+    parser.add_argument('--queue-reset', action = 'store_true', help = 'clear the work queue before adding the participants')
+    parser.add_argument('--cluster-jobs', type = int, default = config.cluster_jobs, help = 'queue workers submitted by the cluster executor (default: %(default)s)')
+    parser.add_argument('--cluster-submit', default = config.cluster_submit,
+                        help = 'command that submits a job script, e.g. sbatch (default: run the jobs as local processes)')
+    return(parser.parse_args(argv))
+
+def apply_args(args):
+    if args.root is not None:
+        config.set_root(os.path.abspath(args.root))
+    config.parallel_cores = args.cores
+    config.total_cores = args.total_cores if args.total_cores is not None else args.cores
+    config.ar_threshold = args.ar_threshold
+    config.autoreject_cv = args.ar_cv
+    config.autoreject_random_state = args.ar_random_state
+    config.export_format = args.export_format
+    config.save_checkpoints = config.save_checkpoints or args.checkpoints
+    config.use_cache = config.use_cache and not args.no_cache
+    config.stage_profiler = args.profiler
+    config.executor = args.executor
+    config.cluster_jobs = args.cluster_jobs
+    config.cluster_submit = args.cluster_submit
+    config.max_attempts = args.max_attempts
+
+def print_parameters(files, stage = None, verbose = None):
+    print('\nPreprocessing will begin with the following parameters:',
+          '\nCPU cores = ', config.parallel_cores,
+          '\nCore budget = ', config.total_cores,
+          '\nAR threshold = ', config.ar_threshold,
+          '\nAR CV folds = ', config.autoreject_cv,
+          '\nAR random state = ', config.autoreject_random_state,
+          '\nAR model reuse = ', 'warm start' if config.autoreject_warm_start else config.reuse_autoreject_model,
+          '\nOverwrite = ', config.overwrite_opts,
+          '\nExport format = ', config.export_format,
+          '\nStage profiler = ', config.stage_profiler,
+          '\nExecutor = ', config.executor,
+          '\nCheckpoints = ', config.save_checkpoints,
+          '\nCached stages = ', config.cached_stages if config.use_cache else None,
+          '\nStages = ', [stage] if stage is not None else config.stages,
+          '\nParticipants = ', len(files),
+          '\nVerbose outout = ', verbose, '\n')
+
+# ------------------------------------------------------------------------------
+# main
+# ------------------------------------------------------------------------------
+
+def main(argv = None):
+    args = parse_args(argv)
+    apply_args(args)
+
+    files = config.participant_files(args.participants)
+
+    # participants that failed in an earlier run, their features are merged
+    # into the existing feature table
+    if args.rerun_failed:
+        from .errors import read_failures
+        failed = read_failures()
+        files = [file for file in files if config.file_splitter(file) in failed]
+        if len(files) == 0:
+            print('No failed participants in', config.failure_manifest_file)
+            return(0)
+
+    if args.dry_run:
+        print_parameters(files, args.stage)
+        print('Participants:', ' '.join(config.file_splitter(file) for file in files))
+        return(0)
+
+    import mne
+    mne.set_config('MNE_LOGGING_LEVEL', 'CRITICAL')
+
+    # queue workers take their parameters and participants from the queue
+    if args.worker:
+        from .executors import join_queue, queue_path, run_queue_workers
+        join_queue()
+        print_parameters(os.listdir(queue_path('pending')), None, mne.get_config(key = 'MNE_LOGGING_LEVEL'))
+        print('Ran', run_queue_workers(), 'participants from', config.queue_dir)
+        return(0)
+
+    print_parameters(files, args.stage, mne.get_config(key = 'MNE_LOGGING_LEVEL'))
+
+    if args.stage is not None:
+        import multiprocessing
+        from mne.parallel import parallel_func
+        from .pipeline import run_single_stage
+        from .runlog import log_writer
+
+        settings = config.settings()
+        manager = multiprocessing.Manager()
+        parallel, run_func, _ = parallel_func(run_single_stage, n_jobs = config.parallel_cores, total = None)
+        with log_writer(manager) as log_queue:
+            parallel(run_func(args.stage, participant, settings, log_queue) for participant in files)
+        manager.shutdown()
+    else:
+        from .pipeline import run_batch
+        if args.queue_reset:
+            from .executors import enqueue
+            enqueue(files, reset = True)
+        run_batch(files, merge_features = args.rerun_failed)
+
+    session_info()
+    return(0)
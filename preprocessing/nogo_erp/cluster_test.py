@@ -0,0 +1,229 @@
+# ==============================================================================
+# Cluster-based permutation test
+#
+# Controls against patients on all channels x times of the evoked data in
+# tmp/evoked/. Student t values, with pooled variance so the threshold has
+# the same degrees of freedom for every relabeling, are clustered over
+# neighbouring channels (a Delaunay triangulation of the montage, as for
+# topomaps) and neighbouring samples, and each cluster is tested against
+# the largest cluster mass of random relabelings of the participants.
+# The t values of a batch of relabelings are computed together with matrix
+# multiplies, batches are spread over parallel_cores workers and each
+# batch has its own seed, derived from cluster_seed, so the result does not
+# depend on the number of cores.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import glob
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import scipy.spatial
+import scipy.stats
+from scipy.sparse.csgraph import connected_components
+
+from . import config
+from .config import file_splitter
+from .grand_average import participant_group
+from .topomap import sensor_positions
+
+# ------------------------------------------------------------------------------
+# data and adjacency
+# ------------------------------------------------------------------------------
+
+def read_group_evoked(condition, groups, tmin = None, tmax = None):
+
+    # evoked data of every participant in groups, participants x channels x
+    # times in µV, cropped to tmin and tmax (in s), with the group of each
+    # participant, their IDs and the info and times of the evoked data
+    import mne
+
+    data, participant_groups, participantids = [], [], []
+    for fname in sorted(glob.glob(config.evoked_data_outputdir + '*_' + condition + '-ave.fif')):
+        participantid = file_splitter(fname)
+        if participant_group(participantid) not in groups:
+            continue
+        evoked = mne.read_evokeds(fname, condition = condition, proj = True, verbose = False)
+        evoked.crop(tmin, tmax)
+        data.append(evoked.data * 1e6)
+        participant_groups.append(participant_group(participantid))
+        participantids.append(participantid)
+    if len(data) == 0:
+        raise FileNotFoundError('No ' + condition + ' evoked data in ' + config.evoked_data_outputdir)
+    return(np.array(data), np.array(participant_groups), participantids, evoked.info, evoked.times)
+
+def channel_adjacency(info):
+
+    # channel pairs that share an edge of the Delaunay triangulation of the
+    # projected sensor positions
+    simplices = scipy.spatial.Delaunay(sensor_positions(info)).simplices
+    pairs = np.vstack([simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [0, 2]]])
+    return(np.unique(np.sort(pairs, axis = 1), axis = 0))
+
+def spatiotemporal_edges(channel_pairs, n_channels, n_times):
+
+    # edges between the channels x times nodes, numbered channel * n_times +
+    # time, neighbouring channels at the same time and the same channel at
+    # neighbouring times
+    time = np.arange(n_times)
+    spatial = [(channel_pairs[:, [0]] * n_times + time).ravel(), (channel_pairs[:, [1]] * n_times + time).ravel()]
+    node = (np.arange(n_channels)[:, np.newaxis] * n_times + time[:-1]).ravel()
+    return(np.concatenate([spatial[0], node]), np.concatenate([spatial[1], node + 1]))
+
+# ------------------------------------------------------------------------------
+# statistics
+# ------------------------------------------------------------------------------
+
+def pooled_t(data, first):
+
+    # two-sample t with pooled variance, n1 + n2 - 2 degrees of freedom, data
+    # is participants x features, first is relabelings x participants, True
+    # for the participants in the first group. The sums of both groups of
+    # all relabelings are two matrix multiplies, data is centered first to
+    # keep the sums of squares accurate
+    data = data - data.mean(axis = 0)
+    first = first.astype(np.float64)
+    n1 = first.sum(axis = 1, keepdims = True)
+    n2 = first.shape[1] - n1
+
+    sum1 = first @ data
+    sumsq1 = first @ data ** 2
+    sum2 = data.sum(axis = 0) - sum1
+    sumsq2 = (data ** 2).sum(axis = 0) - sumsq1
+
+    mean1, mean2 = sum1 / n1, sum2 / n2
+    pooled_var = (sumsq1 - sum1 * mean1 + sumsq2 - sum2 * mean2) / (n1 + n2 - 2)
+    return((mean1 - mean2) / np.sqrt(pooled_var * (1. / n1 + 1. / n2)))
+
+def find_clusters(t, threshold, edges):
+
+    # positive and negative clusters of nodes with |t| above threshold,
+    # returns a label per node (-1 outside clusters) and the mass, the sum
+    # of t, of each cluster
+    labels = np.full(len(t), -1)
+    masses = []
+    for sign in [1, -1]:
+        above = sign * t > threshold
+        keep = above[edges[0]] & above[edges[1]]
+        graph = scipy.sparse.coo_matrix((np.ones(keep.sum()), (edges[0][keep], edges[1][keep])), shape = (len(t), len(t)))
+        components = connected_components(graph, directed = False)[1][above]
+
+        # components are numbered over all nodes, only those above threshold are clusters
+        numbers, components = np.unique(components, return_inverse = True)
+        labels[above] = components + len(masses)
+        masses.extend(np.bincount(components, weights = t[above], minlength = len(numbers)))
+    return(labels, np.array(masses))
+
+def max_cluster_mass(t, threshold, edges):
+    labels, masses = find_clusters(t, threshold, edges)
+    return(np.abs(masses).max(initial = 0.))
+
+def relabel(rng, num_permutations, n_participants, n_first):
+
+    # random group labels, n_first participants in the first group
+    order = np.argsort(rng.random((num_permutations, n_participants)), axis = 1)
+    first = np.zeros((num_permutations, n_participants), dtype = bool)
+    np.put_along_axis(first, order[:, :n_first], True, axis = 1)
+    return(first)
+
+def run_batches(data, n_first, threshold, edges, batches):
+
+    # largest cluster mass of each relabeling, batches is a list of
+    # (seed, number of relabelings), run in a worker
+    null = []
+    for seed, num_permutations in batches:
+        rng = np.random.default_rng(seed)
+        t = pooled_t(data, relabel(rng, num_permutations, len(data), n_first))
+        null.append([max_cluster_mass(t_permutation, threshold, edges) for t_permutation in t])
+    return(null)
+
+# ------------------------------------------------------------------------------
+# cluster test
+# ------------------------------------------------------------------------------
+
+def permutation_cluster_test(data, is_first, edges, num_permutations = 10000, alpha = 0.05, seed = 42,
+                             batch_size = 50, n_jobs = 1):
+
+    # data is participants x features, is_first marks the first group.
+    # Returns the observed t values, cluster labels, cluster masses and
+    # cluster p values, and the largest cluster mass of each relabeling
+    from mne.parallel import parallel_func
+
+    # pooled_t has n1 + n2 - 2 degrees of freedom with any group labels
+    n_first = int(is_first.sum())
+    df = len(data) - 2
+    threshold = scipy.stats.t.ppf(1 - alpha / 2, df)
+
+    t_observed = pooled_t(data, is_first[np.newaxis])[0]
+    labels, masses = find_clusters(t_observed, threshold, edges)
+
+    # batches are dealt to the workers in turn and put back in order, so the
+    # same seed gives the same null distribution with any number of cores
+    sizes = [batch_size] * (num_permutations // batch_size) + ([num_permutations % batch_size] if num_permutations % batch_size > 0 else [])
+    batches = list(zip(np.random.SeedSequence(seed).spawn(len(sizes)), sizes))
+    n_jobs = max(1, min(n_jobs, len(batches)))
+    parallel, run_func, _ = parallel_func(run_batches, n_jobs = n_jobs, total = None)
+    results = parallel(run_func(data, n_first, threshold, edges, batches[job::n_jobs]) for job in range(n_jobs))
+
+    null = [None] * len(batches)
+    for job, result in enumerate(results):
+        null[job::n_jobs] = result
+    null = np.concatenate(null)
+
+    p_values = (np.sum(null[np.newaxis] >= np.abs(masses)[:, np.newaxis], axis = 1) + 1) / (len(null) + 1)
+    return(t_observed, labels, masses, p_values, null)
+
+def cluster_table(labels, masses, p_values, t, ch_names, times):
+
+    # one row per cluster, largest mass first, labels and t are channels x times
+    rows = []
+    for cluster, (mass, p_value) in enumerate(zip(masses, p_values)):
+        channels, samples = np.nonzero(labels == cluster)
+        rows.append({
+         'cluster': cluster,
+         'sign': 'positive' if mass > 0 else 'negative',
+         'mass': mass,
+         'p_value': p_value,
+         'start': np.round(times[samples.min()] * 1e3),
+         'end': np.round(times[samples.max()] * 1e3),
+         'num_channels': len(np.unique(channels)),
+         'peak_t': t[channels, samples][np.argmax(np.abs(t[channels, samples]))],
+         'channels': ' '.join(ch_names[c] for c in np.unique(channels))
+        })
+    table = pd.DataFrame(rows, columns = ['cluster', 'sign', 'mass', 'p_value', 'start', 'end',
+                                          'num_channels', 'peak_t', 'channels'])
+    return(table.reindex(table['mass'].abs().sort_values(ascending = False).index).reset_index(drop = True))
+
+def run_cluster_test(condition = None, fname = None):
+
+    # controls minus patients, the first and second of cluster_groups, for
+    # the evoked data in tmp/evoked/, the clusters are written to output/data/
+    # and the t values and cluster labels are returned for plotting
+    condition = config.cluster_condition if condition is None else condition
+    fname = config.cluster_test_file if fname is None else fname
+
+    data, groups, participantids, info, times = read_group_evoked(condition, config.cluster_groups,
+                                                                  config.cluster_tmin, config.cluster_tmax)
+    is_first = groups == config.cluster_groups[0]
+    if is_first.sum() < 2 or (~is_first).sum() < 2:
+        raise ValueError('The cluster test needs at least two participants in each of ' + ', '.join(config.cluster_groups))
+
+    n_channels, n_times = data.shape[1:]
+    edges = spatiotemporal_edges(channel_adjacency(info), n_channels, n_times)
+    t, labels, masses, p_values, null = permutation_cluster_test(data.reshape(len(data), -1), is_first, edges,
+                                                                 num_permutations = config.cluster_permutations,
+                                                                 alpha = config.cluster_alpha,
+                                                                 seed = config.cluster_seed,
+                                                                 batch_size = config.cluster_batch_size,
+                                                                 n_jobs = config.parallel_cores)
+    t = t.reshape(n_channels, n_times)
+    labels = labels.reshape(n_channels, n_times)
+
+    table = cluster_table(labels, masses, p_values, t, info['ch_names'], times)
+    table.insert(0, 'condition', condition)
+    table.insert(1, 'contrast', config.cluster_groups[0] + ' - ' + config.cluster_groups[1])
+    table.to_csv(fname, index = False)
+    return(table, t, labels, p_values, info, times)
@@ -0,0 +1,271 @@
+# ==============================================================================
+# Preprocessing parameters and directories
+#
+# Every stage reads its parameters from this module, so settings changed
+# here (or from the command line) apply to all of them. Worker processes
+# import a fresh copy, settings() and apply() hand them the current values.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import os
+
+# ------------------------------------------------------------------------------
+# prepare directories
+# ------------------------------------------------------------------------------
+
+# input, tmp and output directories relative to the root, by default the
+# preprocessing directory this package lives in
+paths = {
+ # bad channels input directory
+ 'bad_channel_inputdir': '/input/bad_channels/',
+ # ICA solutions input directory
+ 'ica_inputdir': '/input/ica_solutions/',
+ 'data_inputdir': '/input/data/',
+ 'montage_file': '/input/montage/GSN-HydroCel-129.sfp',
+ # temp data directories
+ 'cropped_data_outputdir': '/tmp/cropped/',
+ 'filtered_data_outputdir': '/tmp/filtered/',
+ 'cleaned_data_outputdir': '/tmp/cleaned/',
+ 'epoched_data_outputdir': '/tmp/epoched/',
+ 'cleaned_epoched_data_outputdir': '/tmp/cleaned_epoched/',
+ 'evoked_data_outputdir': '/tmp/evoked/',
+ # running sums of the evoked data per group, see grand_average.py
+ 'grand_average_file': '/tmp/evoked/grand_average.npz',
+ 'cache_outputdir': '/tmp/cache/',
+ 'autoreject_model_outputdir': '/tmp/autoreject/',
+ 'epochs_store_outputdir': '/tmp/epochs_store/',
+ # work queue of the queue and cluster executors, on a shared filesystem
+ 'queue_dir': '/tmp/queue/',
+ # output directories
+ 'averaged_data_outputdir': '/output/data/',
+ 'raw_averaged_data_outputdir': '/output/raw_data/',
+ 'plot_outputdir': '/output/plots/',
+ 'log_outputdir': '/output/logs/',
+ 'profile_outputdir': '/output/logs/profiles/',
+ # stage logs of all participants, see runlog.py
+ 'cohort_log_file': '/output/logs/cohort_log.jsonl',
+ # participants whose last run failed, see errors.py
+ 'failure_manifest_file': '/output/logs/failed_participants.json',
+ # split-half reliability of the ERP features, see reliability.py
+ 'reliability_file': '/output/data/reliability.csv',
+ # clusters of the group comparison, see cluster_test.py
+ 'cluster_test_file': '/output/data/cluster_test.csv'
+}
+
+def set_root(root):
+
+    # points every directory in paths at root
+    global current_pwd
+    current_pwd = root
+    for name, path in paths.items():
+        globals()[name] = root + path
+
+set_root(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+# ------------------------------------------------------------------------------
+# preprocessing parameters
+# ------------------------------------------------------------------------------
+
+# filters
+raw_filter_highpass = 0.1
+raw_filter_lowpass = 30
+raw_ica_filter_highpass = 1
+raw_ica_filter_lowpass = 30
+filter_method = 'fir'
+filter_phase = 'zero'
+fir_window = 'hamming'
+fir_design = 'firwin'
+
+# filter both bands in a single pass over the data, with bad channel
+# interpolation and re-referencing done once before filtering
+dual_band_filter = True
+
+# the epochs are resampled to target_sfreq, or, with decimate_epochs, every
+# k-th sample is kept as they are read when that is safe after the lowpass
+# filter (see decimation_factor), with the events found at the original
+# rate. It is off by default, the epochs differ slightly from resampled ones
+decimate_epochs = False
+target_sfreq = 500
+
+# when epoching from a checkpoint, only the samples of the epochs are read,
+# from the ICA cleaned data or, if there is none, from the filtered data
+# with the ICA applied to the epochs
+lazy_epoching = True
+
+# the ICA is applied as one channels x channels matrix, cached under
+# tmp/cache/ with the hash of the ICA file, instead of with ica.apply()
+ica_cleaning_matrix = True
+
+# epochs
+tmin = -0.2
+tmax = 0.8
+baseline = (-0.2, .0)
+
+# trial classification, each rule is (new name, new code, event it applies to,
+# offset of the neighbouring event, names the neighbour may have)
+event_rules = [
+    ('gocorr', 11, 'Go', 1, ['Response']),
+    ('nogocorr', 101, 'NoGo', 1, ['Go', 'NoGo']),
+    ('nogoincorr', 102, 'Response', -1, ['NoGo']) # response locked
+]
+
+# ERP features, nine frontal electrodes distributed evenly from the midline
+# form a frontocentral ROI, each window is (component, start, end, polarity)
+roi_channels = ['E20', 'E12', 'E5', 'E118', 'E13', 'E6', 'E112', 'E7', 'E106']
+feature_windows = [
+    ('n2', 0.225, 0.325, 'negative'),
+    ('p3', 0.325, 0.625, 'positive')
+]
+feature_conditions = ['nogocorr']
+
+# conditions saved for each participant, averaged and single trial, and
+# difference waves of their averages, each is (name, condition, condition
+# subtracted). Conditions without epochs are left out
+export_conditions = ['gocorr', 'nogocorr', 'nogoincorr']
+difference_waves = [('nogo_minus_go', 'nogocorr', 'gocorr')]
+
+# split-half reliability of the features in feature_windows, over
+# reliability_splits random splits of the single trials of
+# reliability_condition, run in chunks of reliability_chunk_size splits
+reliability_condition = 'nogocorr'
+reliability_splits = 5000
+reliability_seed = 42
+reliability_chunk_size = 500
+
+# cluster permutation test of the first against the second of cluster_groups
+# on the evoked cluster_condition data of all channels from cluster_tmin to
+# cluster_tmax (in s, None for the start or end of the epochs), clusters are
+# formed at a two-sided cluster_alpha, cluster_batch_size relabelings of the
+# cluster_permutations are computed together
+cluster_condition = 'nogocorr'
+cluster_groups = ['KON', 'RPK']
+cluster_tmin = 0.
+cluster_tmax = None
+cluster_permutations = 10000
+cluster_alpha = 0.05
+cluster_seed = 42
+cluster_batch_size = 50
+
+# stages in the order they are run
+stages = ['prepare', 'filter', 'ica', 'epoch', 'autoreject']
+
+# ------------------------------------------------------------------------------
+# run parameters
+# ------------------------------------------------------------------------------
+
+parallel_cores = int(12)
+
+# total core budget shared between participants and the n_jobs used inside
+# the filter and AR stages
+total_cores = int(12)
+ar_threshold = int(4)
+autoreject_cv = int(10)
+autoreject_random_state = int(2020)
+
+overwrite_opts = True
+
+# intermediate files under tmp/ are only written if checkpoints are enabled,
+# otherwise data is passed between stages in memory
+save_checkpoints = False
+
+# stage results are cached under tmp/cache/, keyed on the input file, the
+# parameters and code of that stage and of all stages before it, so re-runs
+# only recompute what changed, the raw stages are large and not cached by default
+use_cache = True
+cached_stages = ['epoch', 'autoreject']
+
+# fitted AR models are kept under tmp/autoreject/ and reused when the epochs and
+# AR parameters are unchanged, a warm start also reuses them when the epochs
+# changed slightly, e.g. after a change of the filters, skipping the refit.
+# Models are always refitted when the bad channels change
+reuse_autoreject_model = True
+autoreject_warm_start = False
+
+# cleaned epochs are kept under tmp/epochs_store/ as a memory-mapped array,
+# float32 unless the average differs by more than epochs_store_tolerance µV
+# from double precision, the save and feature stages read only the epochs
+# they use from it instead of holding all epochs in memory
+epochs_store = True
+epochs_store_dtype = 'float32'
+epochs_store_tolerance = 1e-3
+
+# how participants are run, 'local' (in parallel on this machine), 'queue'
+# (a work queue under tmp/queue/ that workers on other nodes can join with
+# --worker) or 'cluster' (submits cluster_jobs queue workers with
+# cluster_submit, e.g. 'sbatch', or runs them as local processes if None).
+# Queue workers touch their claim every queue_heartbeat seconds, claims
+# without a heartbeat for queue_timeout seconds are taken for a dead worker
+# and run again
+executor = 'local'
+queue_heartbeat = 30
+queue_timeout = 300
+cluster_jobs = 4
+cluster_submit = None
+
+# a failed participant does not stop the batch, the error is logged and added
+# to output/logs/failed_participants.json, participants that failed with an
+# error that may not happen again (out of memory, I/O, a crashed worker) are
+# run up to max_attempts times
+max_attempts = 3
+
+# format of the averaged and single-trial data in output/, 'csv', 'parquet'
+# (float32, one column per channel) or 'npy' (float32 array with a json sidecar)
+export_format = 'csv'
+
+# wall time, CPU time, peak RSS and I/O of each stage are always logged, a
+# per-stage profile can also be written to output/logs/profiles/ by setting
+# this to 'cprofile' (.prof, for pstats/snakeviz) or 'pyinstrument' (.html)
+stage_profiler = None
+
+# ------------------------------------------------------------------------------
+# share settings with worker processes
+# ------------------------------------------------------------------------------
+
+parameters = ['raw_filter_highpass', 'raw_filter_lowpass', 'raw_ica_filter_highpass',
+              'raw_ica_filter_lowpass', 'filter_method', 'filter_phase', 'fir_window',
+              'fir_design', 'dual_band_filter', 'decimate_epochs', 'target_sfreq',
+              'lazy_epoching', 'ica_cleaning_matrix', 'tmin', 'tmax', 'baseline', 'event_rules',
+              'roi_channels', 'feature_windows', 'feature_conditions', 'export_conditions',
+              'difference_waves', 'reliability_condition', 'reliability_splits',
+              'reliability_seed', 'reliability_chunk_size', 'cluster_condition',
+              'cluster_groups', 'cluster_tmin', 'cluster_tmax', 'cluster_permutations',
+              'cluster_alpha', 'cluster_seed', 'cluster_batch_size', 'parallel_cores',
+              'total_cores', 'ar_threshold', 'autoreject_cv', 'autoreject_random_state',
+              'overwrite_opts', 'save_checkpoints', 'use_cache', 'cached_stages',
+              'reuse_autoreject_model', 'autoreject_warm_start', 'epochs_store',
+              'epochs_store_dtype', 'epochs_store_tolerance', 'executor',
+              'queue_heartbeat', 'queue_timeout', 'cluster_jobs', 'cluster_submit',
+              'max_attempts', 'export_format', 'stage_profiler']
+
+def settings():
+
+    # current root and parameters, as a plain picklable dictionary
+    current = {name: globals()[name] for name in parameters}
+    current['current_pwd'] = current_pwd
+    return(current)
+
+def apply(current):
+    set_root(current['current_pwd'])
+    for name in parameters:
+        globals()[name] = current[name]
+
+# ------------------------------------------------------------------------------
+# input files
+# ------------------------------------------------------------------------------
+
+def file_splitter(file):
+    file = file.rstrip(os.sep)
+    file = os.path.basename(file)
+    file, sep, tail = file.partition('_')
+    return(file)
+
+def participant_files(participantids = None):
+
+    # recordings in input/data/, optionally only those of some participants
+    files = sorted(os.listdir(data_inputdir))
+    if participantids is not None:
+        files = [file for file in files if file_splitter(file) in participantids]
+    return(files)
@@ -0,0 +1,168 @@
+# ==============================================================================
+# Memory-mapped epochs store
+#
+# Cleaned epochs as one contiguous epochs x channels x times .npy array,
+# float32 by default, with the measurement info in a .fif file and events,
+# times and the precision check in a JSON sidecar. The array is opened as
+# a memory map, so selecting conditions, averaging and feature extraction
+# only read the epochs they use instead of loading the whole float64
+# epochs into every worker.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import os
+import json
+import mne
+import numpy as np
+
+# ------------------------------------------------------------------------------
+# store
+# ------------------------------------------------------------------------------
+
+# epochs read at a time when averaging and checking the precision
+chunk_size = 64
+
+class EpochsStore(object):
+
+    # read only stand-in for mne.Epochs, with the attributes and methods used
+    # by save_data, extract_features and count_epochs. Selecting a condition
+    # returns a store with an index into the same memory map
+    def __init__(self, data, info, times, events, event_id, selection, index = None):
+        self.data = data
+        self.info = info
+        self.ch_names = info['ch_names']
+        self.times = times
+        self.index = np.arange(len(data)) if index is None else index
+        self.events = events[self.index]
+        self.selection = selection[self.index]
+        codes = set(self.events[:, 2])
+        self.event_id = {name: code for name, code in event_id.items() if code in codes or index is None}
+        self.base = (events, event_id, selection)
+
+    def __len__(self):
+        return(len(self.index))
+
+    def __getitem__(self, condition):
+
+        # a condition name or a list of them, as in epochs['nogocorr']
+        events, event_id, selection = self.base
+        names = [condition] if isinstance(condition, str) else list(condition)
+        missing = [name for name in names if name not in self.event_id]
+        if len(missing) > 0:
+            raise KeyError('Event "' + ', '.join(missing) + '" is not in the epochs store')
+
+        codes = [self.event_id[name] for name in names]
+        index = self.index[np.isin(self.events[:, 2], codes)]
+        return(EpochsStore(self.data, self.info, self.times, events, event_id, selection, index))
+
+    def get_data(self):
+
+        # float64 copy of the selected epochs only
+        return(np.asarray(self.data[self.index], dtype = np.float64))
+
+    def average(self):
+
+        # accumulated in float64, a chunk of epochs at a time
+        total = np.zeros(self.data.shape[1:], dtype = np.float64)
+        for start in range(0, len(self.index), chunk_size):
+            total += self.data[self.index[start:start + chunk_size]].sum(axis = 0, dtype = np.float64)
+        comment = ' + '.join(self.event_id.keys())
+        return(mne.EvokedArray(total / len(self.index), self.info, tmin = self.times[0],
+                               comment = comment, nave = len(self.index)))
+
+    def to_epochs(self):
+
+        # the selected epochs as mne.EpochsArray, e.g. for to_data_frame()
+        epochs = mne.EpochsArray(self.get_data(), self.info, events = self.events,
+                                 tmin = self.times[0], event_id = self.event_id,
+                                 baseline = None, verbose = False)
+        epochs.selection = self.selection
+        return(epochs)
+
+    def to_data_frame(self, *args, **kwargs):
+        return(self.to_epochs().to_data_frame(*args, **kwargs))
+
+def epoch_blocks(epochs, block_size = chunk_size):
+
+    # (index of the first epoch, float64 block of epochs) over the selected
+    # epochs, read from the memory map of a store or taken from the data of
+    # preloaded mne.Epochs, without copying all epochs at once
+    for start in range(0, len(epochs), block_size):
+        if isinstance(epochs, EpochsStore):
+            block = np.asarray(epochs.data[epochs.index[start:start + block_size]], dtype = np.float64)
+        else:
+            block = epochs._data[start:start + block_size]
+        yield(start, block)
+
+# ------------------------------------------------------------------------------
+# write and read
+# ------------------------------------------------------------------------------
+
+def write_epochs_store(epochs, fname, dtype = 'float32', tolerance = 1e-3, key = None):
+
+    # fname is given without extension, the files are written next to it and
+    # renamed once complete, key is stored to tell which input it came from.
+    # The epochs are stored a block at a time and each block is compared to
+    # the double precision epochs as it is written, the largest difference
+    # in µV of the epochs and of their average is returned. Raises if the
+    # average differs by more than tolerance µV
+    tmp_fname = fname + '.tmp'
+    shape = (len(epochs), len(epochs.ch_names), len(epochs.times))
+    stored = np.lib.format.open_memmap(tmp_fname + '.npy', mode = 'w+', dtype = dtype, shape = shape)
+
+    error = 0.
+    total = np.zeros(shape[1:], dtype = np.float64)
+    total_stored = np.zeros(shape[1:], dtype = np.float64)
+    for start, block in epoch_blocks(epochs):
+        stored[start:start + len(block)] = block
+        block_stored = stored[start:start + len(block)].astype(np.float64)
+        error = max(error, np.abs(block_stored - block).max(initial = 0.))
+        total += block.sum(axis = 0)
+        total_stored += block_stored.sum(axis = 0)
+    stored.flush()
+    del stored
+
+    average_error = np.abs(total_stored - total).max(initial = 0.) / max(shape[0], 1)
+    precision = {'max_abs_error_uv': float(error * 1e6), 'max_abs_error_average_uv': float(average_error * 1e6)}
+    if precision['max_abs_error_average_uv'] > tolerance:
+        os.remove(tmp_fname + '.npy')
+        raise ValueError('Average of ' + dtype + ' epochs differs by ' + str(precision['max_abs_error_average_uv']) +
+                         ' µV from double precision, above the tolerance of ' + str(tolerance) + ' µV')
+
+    mne.io.write_info(tmp_fname + '-info.fif', epochs.info)
+    sidecar = {
+     'dims': ['epoch', 'channel', 'time'],
+     'dtype': dtype,
+     'unit': 'V',
+     'times': epochs.times.tolist(),
+     'events': epochs.events.tolist(),
+     'event_id': epochs.event_id,
+     'selection': [int(e) for e in epochs.selection],
+     'precision': precision,
+     'key': key
+    }
+    with open(tmp_fname + '.json', 'w') as f:
+        json.dump(sidecar, f)
+
+    for extension in ['-info.fif', '.npy', '.json']:
+        os.replace(tmp_fname + extension, fname + extension)
+    return(precision)
+
+def read_epochs_store_key(fname):
+
+    # key of a store, None if there is no store
+    if not os.path.isfile(fname + '.json'):
+        return(None)
+    with open(fname + '.json', 'r') as f:
+        return(json.load(f)['key'])
+
+def read_epochs_store(fname):
+    with open(fname + '.json', 'r') as f:
+        sidecar = json.load(f)
+    data = np.load(fname + '.npy', mmap_mode = 'r')
+    info = mne.io.read_info(fname + '-info.fif', verbose = False)
+    return(EpochsStore(data, info, np.array(sidecar['times']), np.array(sidecar['events'], dtype = int).reshape(-1, 3),
+                       sidecar['event_id'], np.array(sidecar['selection'], dtype = int)))
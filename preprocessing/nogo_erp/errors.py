@@ -0,0 +1,96 @@
+# ==============================================================================
+# Preprocessing errors
+#
+# Errors raised for a single participant. They carry the participant and
+# stage, and whether running the participant again could help, so a batch
+# can record them, retry those that may pass and carry on with the rest.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import os
+import json
+import traceback
+
+from . import config
+
+# ------------------------------------------------------------------------------
+# errors
+# ------------------------------------------------------------------------------
+
+class PreprocessingError(Exception):
+
+    # retry is False for errors that will happen again on the same input
+    retry = False
+
+    def __init__(self, participantid, stage, message):
+        Exception.__init__(self, participantid + ', ' + stage + ': ' + message)
+        self.participantid = participantid
+        self.stage = stage
+
+class EventCountError(PreprocessingError):
+
+    # the recording does not have the Go/NoGo/Response (and Pause) event types
+    pass
+
+class StageError(PreprocessingError):
+
+    # any other error in a stage, raised from the original one. Missing files
+    # and bad values will fail again, running out of memory or other I/O
+    # errors, e.g. on a shared filesystem, may not
+    def __init__(self, participantid, stage, cause):
+        PreprocessingError.__init__(self, participantid, stage, type(cause).__name__ + ': ' + str(cause))
+        self.cause = cause
+        self.retry = isinstance(cause, (MemoryError, OSError)) and not isinstance(cause, (FileNotFoundError, PermissionError))
+
+# ------------------------------------------------------------------------------
+# failure records
+# ------------------------------------------------------------------------------
+
+def failure_record(error, participantid = None):
+
+    # plain dictionary for the cohort log and the failure manifest, errors
+    # that are not a PreprocessingError, e.g. a crashed worker, are retried
+    cause = error.cause if isinstance(error, StageError) else error
+    return({
+     'ID': getattr(error, 'participantid', participantid),
+     'stage': getattr(error, 'stage', None),
+     'error': type(cause).__name__,
+     'message': str(cause),
+     'retry': getattr(error, 'retry', True),
+     'traceback': ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+    })
+
+# ------------------------------------------------------------------------------
+# failure manifest
+# ------------------------------------------------------------------------------
+
+def read_failures(fname = None):
+
+    # participants whose last run failed, by ID
+    fname = config.failure_manifest_file if fname is None else fname
+    if not os.path.isfile(fname):
+        return({})
+    with open(fname, 'r') as f:
+        return(json.load(f))
+
+def update_failures(outcomes, fname = None):
+
+    # adds the failed participants of a batch to the manifest and removes
+    # those that succeeded, participants not in the batch are kept
+    fname = config.failure_manifest_file if fname is None else fname
+    failures = read_failures(fname)
+    for outcome in outcomes:
+        participantid = config.file_splitter(outcome['participant'])
+        if outcome['error'] is None:
+            failures.pop(participantid, None)
+        else:
+            failures[participantid] = dict(outcome['error'], participant = outcome['participant'], 
+                                           attempts = outcome.get('attempts', 1))
+
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(failures, f, indent = 1)
+    os.replace(fname + '.tmp', fname)
+    return(failures)
@@ -0,0 +1,72 @@
+# ==============================================================================
+# Event and epoch counting
+#
+# Counting and relabeling of Go/NoGo events, shared by the epoch and AR
+# stages and the pipeline.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import numpy as np
+
+# ------------------------------------------------------------------------------
+# event counter
+# ------------------------------------------------------------------------------
+
+def count_events(events, event_id):
+
+    # number of events for each condition in event_id, read straight from
+    # the event codes
+    codes = events[:, 2]
+    counts = np.bincount(codes, minlength = max(event_id.values(), default = 0) + 1)
+    return({name: int(counts[code]) for name, code in event_id.items()})
+
+def count_epochs(epochs, conditions):
+
+    # number of epochs per condition without selecting sub-epochs,
+    # conditions missing from epochs.event_id are counted as zero
+    counts = count_events(epochs.events, epochs.event_id)
+    return({condition: counts.get(condition, 0) for condition in conditions})
+
+# ------------------------------------------------------------------------------
+# trial classification
+# ------------------------------------------------------------------------------
+
+def classify_events(events, event_id, rules):
+
+    # relabels events based on their neighbours, using the original codes
+    # throughout. Each rule is (new name, new code, event it applies to,
+    # offset of the neighbour to check, names the neighbour may have), and
+    # the first matching rule wins. Returns the relabeled events, an event_id
+    # for the new labels that occur, and the number of events per new label.
+    codes = events[:, 2]
+    new_events = events.copy()
+    matched = np.zeros(len(codes), dtype = bool)
+
+    for name, new_code, anchor, offset, neighbours in rules:
+        neighbour_codes = [event_id[n] for n in neighbours if n in event_id]
+
+        # code of the neighbouring event, events without one never match
+        neighbour = np.full(len(codes), -1)
+        if offset > 0:
+            neighbour[:-offset] = codes[offset:]
+        else:
+            neighbour[-offset:] = codes[:offset]
+
+        hits = ~matched & np.isin(neighbour, neighbour_codes)
+        if anchor in event_id:
+            hits &= codes == event_id[anchor]
+        else:
+            hits[:] = False
+
+        new_events[hits, 2] = new_code
+        matched |= hits
+
+    # only events that matched a rule can carry the new codes
+    rule_event_id = {rule[0]: rule[1] for rule in rules}
+    event_counts = count_events(new_events[matched], rule_event_id)
+    new_event_id = {name: code for name, code in rule_event_id.items() if event_counts[name] > 0}
+
+    return(new_events, new_event_id, event_counts)
@@ -0,0 +1,411 @@
+# ==============================================================================
+# Executors
+#
+# run_batch hands the participants to one of these backends:
+#
+#   local    participants in parallel on this machine, in a process pool
+#   queue    a work queue of files on a shared filesystem, any number of
+#            nodes claim participants from it, see queue_worker()
+#   cluster  submits queue workers as jobs to a cluster scheduler, or runs
+#            them as local processes when no submit command is set
+#
+# All backends return the outcome of each participant, its features or the
+# error it failed with, and write to the same output/ layout.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import multiprocessing
+import socket
+import subprocess
+import threading
+import time
+
+from . import config
+from .config import file_splitter
+from .errors import failure_record
+from .runlog import log_writer
+from .scheduler import CoreScheduler
+
+# ------------------------------------------------------------------------------
+# local
+# ------------------------------------------------------------------------------
+
+def run_tracked(participant, scheduler, settings, log_queue, started):
+
+    # run_isolated in a pool worker, marking the participant as started so a
+    # worker that dies can be narrowed down to the participants it may have run
+    from .pipeline import run_isolated
+
+    started[participant] = True
+    return(run_isolated(participant, scheduler, settings, log_queue))
+
+def run_pool(manager, participants, n_jobs, settings, log_queue, started):
+
+    # outcomes of the participants that finished, and those that did not
+    # because a worker process died, e.g. killed when out of memory, which
+    # stops the whole pool
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from concurrent.futures.process import BrokenProcessPool
+
+    scheduler = CoreScheduler(manager, config.total_cores, n_jobs, len(participants))
+    results = {}
+    with ProcessPoolExecutor(max_workers = n_jobs) as pool:
+        futures = {pool.submit(run_tracked, participant, scheduler, settings, log_queue, started): participant 
+                   for participant in participants}
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except BrokenProcessPool:
+                pass
+    return(results, [participant for participant in participants if participant not in results])
+
+def run_attempt(manager, participants, settings, log_queue):
+
+    # runs the participants in parallel, one at a time per worker. If a
+    # worker dies, the participants that had started and not finished are
+    # run again one at a time, so only the one that crashes fails, and those
+    # that had not started go back into the parallel pool
+    started = manager.dict()
+    results, unfinished = run_pool(manager, participants, config.parallel_cores, settings, log_queue, started)
+
+    while len(unfinished) > 0:
+        suspects = [participant for participant in unfinished if participant in started]
+        waiting = [participant for participant in unfinished if participant not in started]
+        print('A worker process died, running', ' '.join(file_splitter(participant) for participant in suspects), 'one at a time')
+
+        for participant in suspects:
+            solo, crashed = run_pool(manager, [participant], 1, settings, log_queue, started)
+            if len(crashed) > 0:
+                error = RuntimeError('worker process died, e.g. out of memory or a crash in a compiled library')
+                solo[participant] = {'participant': participant, 'features': None, 
+                                     'error': failure_record(error, file_splitter(participant))}
+            results.update(solo)
+
+        started.clear()
+        more, unfinished = run_pool(manager, waiting, config.parallel_cores, settings, log_queue, started) if len(waiting) > 0 else ({}, [])
+        results.update(more)
+    return(results)
+
+def run_local(files):
+
+    # participants that failed with an error worth retrying are run again,
+    # logs are written by one thread in this process as the workers send them
+    manager = multiprocessing.Manager()
+    outcomes = {}
+    remaining = list(files)
+
+    settings = config.settings()
+    with log_writer(manager) as log_queue:
+        for attempt in range(1, config.max_attempts + 1):
+            results = run_attempt(manager, remaining, settings, log_queue)
+            for participant in remaining:
+                results[participant]['attempts'] = attempt
+                outcomes[participant] = results[participant]
+            remaining = [participant for participant in remaining 
+                         if results[participant]['error'] is not None and results[participant]['error']['retry']]
+            if len(remaining) == 0 or attempt == config.max_attempts:
+                break
+            print('Retrying', len(remaining), 'participants, attempt', attempt + 1, 'of', config.max_attempts)
+
+    manager.shutdown()
+    return([outcomes[participant] for participant in files])
+
+# ------------------------------------------------------------------------------
+# file-based queue
+# ------------------------------------------------------------------------------
+
+# a task is a small JSON file that moves between these directories, claims
+# are renames, which are atomic on a shared POSIX filesystem, so exactly one
+# worker gets each participant
+queue_states = ['pending', 'claimed', 'done', 'failed', 'results']
+
+def queue_path(state, name = ''):
+    return(config.queue_dir + state + '/' + name)
+
+def read_task(path):
+    with open(path, 'r') as f:
+        return(json.load(f))
+
+def write_task(path, task):
+    tmp_path = path + '.tmp.' + str(os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(task, f)
+    os.replace(tmp_path, path)
+
+# settings that do not change the results, they may differ between runs
+# and nodes of the same queue
+run_settings = ['current_pwd', 'parallel_cores', 'total_cores', 'executor', 'queue_heartbeat',
+                'queue_timeout', 'cluster_jobs', 'cluster_submit', 'max_attempts']
+
+def result_settings(settings):
+
+    # the settings that change the results, as they are stored in settings.json
+    return(json.loads(json.dumps({name: value for name, value in settings.items() if name not in run_settings})))
+
+def enqueue(files, reset = False):
+
+    # queues every participant in files that is not being run right now,
+    # also those that are done or failed, as their input, ICA or bad
+    # channels may have changed. The stage cache skips whatever is still up
+    # to date. The settings of this run are stored with the queue for the
+    # workers that join it, if they changed since the queue was made the
+    # results of all participants are dropped
+    if reset and os.path.isdir(config.queue_dir):
+        import shutil
+        shutil.rmtree(config.queue_dir)
+    for state in queue_states:
+        os.makedirs(queue_path(state), exist_ok = True)
+
+    settings_file = config.queue_dir + 'settings.json'
+    if os.path.isfile(settings_file) and result_settings(read_task(settings_file)) != result_settings(config.settings()):
+        if len(os.listdir(queue_path('claimed'))) > 0:
+            raise RuntimeError('The settings differ from those of the queue in ' + config.queue_dir +
+                               ' and workers are still running with them, wait for them to finish or use --queue-reset')
+        print('Settings changed since the queue was made, clearing its done tasks and results')
+        for state in ['done', 'failed', 'results']:
+            for name in os.listdir(queue_path(state)):
+                os.remove(queue_path(state, name))
+    write_task(settings_file, config.settings())
+
+    claimed = set(os.listdir(queue_path('claimed')))
+    for participant in files:
+        name = file_splitter(participant) + '.json'
+        if name in claimed:
+            continue
+        for state, state_name in [('done', name), ('failed', name), ('results', file_splitter(participant) + '.csv')]:
+            try:
+                os.remove(queue_path(state, state_name))
+            except FileNotFoundError:
+                pass
+        write_task(queue_path('pending', name), {'participant': participant, 'attempts': 0, 'errors': []})
+
+def join_queue():
+
+    # workers use the settings of the queue, but keep their own root and cores
+    if not os.path.isfile(config.queue_dir + 'settings.json'):
+        raise FileNotFoundError('No queue in ' + config.queue_dir + ', start one with --executor queue or cluster')
+    settings = read_task(config.queue_dir + 'settings.json')
+    for name in ['current_pwd', 'parallel_cores', 'total_cores']:
+        settings[name] = config.settings()[name]
+    config.apply(settings)
+
+def claim_task():
+
+    # the first pending task this worker manages to rename, None if there are
+    # none left. A rename keeps the modification time the task had while it
+    # was pending, so it is touched at once, or requeue_stale() of another
+    # worker would take a task that waited longer than queue_timeout
+    for name in sorted(os.listdir(queue_path('pending'))):
+        if name.endswith('.json'):
+            try:
+                os.rename(queue_path('pending', name), queue_path('claimed', name))
+                os.utime(queue_path('claimed', name))
+            except FileNotFoundError:
+                continue
+            return(name)
+    return(None)
+
+def release_task(name, task, error, claimed_name = None):
+
+    # failed tasks go back to pending until they are out of attempts, unless
+    # the error will happen again, claimed_name is the name of the claim if
+    # it was renamed
+    claimed_name = name if claimed_name is None else claimed_name
+    task['attempts'] = task['attempts'] + 1
+    task['errors'].append(error)
+    state = 'failed' if not error['retry'] or task['attempts'] >= config.max_attempts else 'pending'
+    write_task(queue_path('claimed', claimed_name), task)
+    os.rename(queue_path('claimed', claimed_name), queue_path(state, name))
+
+def requeue_stale():
+
+    # claims whose heartbeat stopped belong to a worker that died, they are
+    # grabbed with a rename so only one worker releases each
+    for name in os.listdir(queue_path('claimed')):
+        path = queue_path('claimed', name)
+        try:
+            stale = time.time() - os.path.getmtime(path) > config.queue_timeout
+        except FileNotFoundError:
+            continue
+        if stale and name.endswith('.json'):
+            stale_name = name + '.stale.' + socket.gethostname() + '.' + str(os.getpid())
+            try:
+                os.rename(path, queue_path('claimed', stale_name))
+            except FileNotFoundError:
+                continue
+            task = read_task(queue_path('claimed', stale_name))
+            error = {'ID': file_splitter(task['participant']), 'stage': None, 'error': 'NoHeartbeat', 
+                     'message': 'no heartbeat from ' + str(task.get('worker')) + ' for ' + str(config.queue_timeout) + ' s', 
+                     'retry': True, 'traceback': None}
+            release_task(name, task, error, stale_name)
+
+class Heartbeat(threading.Thread):
+
+    # touches a claimed task every interval seconds while it is being run
+    def __init__(self, path, interval):
+        threading.Thread.__init__(self, daemon = True)
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def queue_worker(scheduler = None, settings = None, log_queue = None):
+
+    # runs participants from the queue until it is empty, returns how many
+    from .pipeline import run_isolated
+
+    if settings is not None:
+        config.apply(settings)
+
+    num_tasks = 0
+    while True:
+        requeue_stale()
+        name = claim_task()
+        if name is None:
+            return(num_tasks)
+
+        # the claim is gone if another worker took it for stale in between
+        path = queue_path('claimed', name)
+        try:
+            task = read_task(path)
+            task['worker'] = socket.gethostname() + ':' + str(os.getpid())
+            write_task(path, task)
+        except FileNotFoundError:
+            continue
+
+        heartbeat = Heartbeat(path, config.queue_heartbeat)
+        heartbeat.start()
+        outcome = run_isolated(task['participant'], scheduler, None, log_queue)
+        heartbeat.stop()
+        if outcome['error'] is not None:
+            release_task(name, task, outcome['error'])
+            continue
+
+        if outcome['features'] is not None:
+            outcome['features'].to_csv(queue_path('results', file_splitter(task['participant']) + '.csv'), index = False)
+        # a claim taken for stale while this worker was still running is
+        # cleared up here, whatever was requeued is done
+        task['attempts'] = task['attempts'] + 1
+        write_task(queue_path('done', name), task)
+        for state in ['claimed', 'pending']:
+            try:
+                os.remove(queue_path(state, name))
+            except FileNotFoundError:
+                pass
+        num_tasks = num_tasks + 1
+
+def run_queue_workers():
+
+    # parallel_cores workers on this node, the core budget is shared as in
+    # run_local, counting the participants pending when the workers start
+    from mne.parallel import parallel_func
+
+    manager = multiprocessing.Manager()
+    num_pending = len(os.listdir(queue_path('pending')))
+    scheduler = CoreScheduler(manager, config.total_cores, config.parallel_cores, max(1, num_pending))
+
+    parallel, run_func, _ = parallel_func(queue_worker, n_jobs = config.parallel_cores, total = None)
+    settings = config.settings()
+    with log_writer(manager) as log_queue:
+        num_tasks = parallel(run_func(scheduler, settings, log_queue) for worker in range(config.parallel_cores))
+
+    manager.shutdown()
+    return(sum(num_tasks))
+
+def wait_for_queue(poll = 10.):
+
+    # until every task is done or failed, other nodes may still be running some
+    while True:
+        requeue_stale()
+        busy = [name for state in ['pending', 'claimed'] for name in os.listdir(queue_path(state)) if name.endswith('.json')]
+        if len(busy) == 0:
+            return
+        time.sleep(poll)
+
+def collect_results(files):
+
+    # outcomes of the participants in files, in the same order as run_local
+    import pandas as pd
+
+    outcomes = []
+    for participant in files:
+        name = file_splitter(participant) + '.json'
+        fname = queue_path('results', file_splitter(participant) + '.csv')
+        outcome = {'participant': participant, 'features': None, 'error': None}
+        if os.path.isfile(queue_path('failed', name)):
+            task = read_task(queue_path('failed', name))
+            outcome.update(error = task['errors'][-1], attempts = task['attempts'])
+        elif os.path.isfile(fname):
+            outcome['features'] = pd.read_csv(fname)
+        outcomes.append(outcome)
+    return(outcomes)
+
+def run_queue(files):
+    enqueue(files)
+    run_queue_workers()
+    wait_for_queue()
+    return(collect_results(files))
+
+# ------------------------------------------------------------------------------
+# cluster
+# ------------------------------------------------------------------------------
+
+def worker_script(cores):
+
+    # shell script that joins the queue as a worker, run by the scheduler
+    package_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    return('\n'.join(['#!/bin/bash',
+                      'cd ' + package_dir,
+                      'exec ' + sys.executable + ' -m nogo_erp --root ' + config.current_pwd +
+                      ' --worker --cores ' + str(cores), '']))
+
+def run_cluster(files):
+
+    # submits cluster_jobs queue workers, each with an equal share of the
+    # cores, with cluster_submit (e.g. 'sbatch') or as local processes
+    enqueue(files)
+    job_dir = config.log_outputdir + 'jobs/'
+    os.makedirs(job_dir, exist_ok = True)
+    cores = max(1, config.parallel_cores // config.cluster_jobs)
+
+    script = job_dir + 'worker.sh'
+    with open(script, 'w') as f:
+        f.write(worker_script(cores))
+    os.chmod(script, 0o755)
+
+    jobs = []
+    for job in range(config.cluster_jobs):
+        if config.cluster_submit is not None:
+            subprocess.run(config.cluster_submit.split() + [script], check = True)
+        else:
+            with open(job_dir + 'worker_' + str(job) + '.log', 'w') as log:
+                jobs.append(subprocess.Popen(['bash', script], stdout = log, stderr = subprocess.STDOUT))
+
+    for job in jobs:
+        job.wait()
+    wait_for_queue()
+    return(collect_results(files))
+
+# ------------------------------------------------------------------------------
+# backends
+# ------------------------------------------------------------------------------
+
+executors = {'local': run_local,
+             'queue': run_queue,
+             'cluster': run_cluster}
@@ -0,0 +1,192 @@
+# ==============================================================================
+# EEG data export functions
+#
+# Writers for averaged and single-trial ERP data, used by the save stage
+# and the export benchmark. Besides the original CSV files, data can be
+# written as Parquet (readable in R with arrow::read_parquet) or as a
+# memory-mappable NPY array with a JSON sidecar. The save stage writes all
+# conditions of a participant to one file, with a condition column.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import json
+import numpy as np
+import pandas as pd
+
+# ------------------------------------------------------------------------------
+# export formats
+# ------------------------------------------------------------------------------
+
+export_formats = ['csv', 'parquet', 'npy']
+
+# file extensions written for each format
+export_extensions = {'csv': ['.csv'],
+                     'parquet': ['.parquet'],
+                     'npy': ['.npy', '.json']}
+
+# ------------------------------------------------------------------------------
+# data frames
+# ------------------------------------------------------------------------------
+
+def erp_data_frame(data, times, ch_names, epochs = None, conditions = None):
+
+    # same channel-column layout as to_data_frame(), one row per time point
+    # (and epoch), time in ms and amplitudes in µV, stored as float32
+    n_epochs, n_channels, n_times = data.shape
+    values = (data * 1e6).astype(np.float32).transpose(0, 2, 1).reshape(n_epochs * n_times, n_channels)
+
+    df = pd.DataFrame(values, columns = ch_names)
+    df.insert(0, 'time', np.tile(np.round(times * 1e3).astype(int), n_epochs))
+    if epochs is not None:
+        df.insert(0, 'epoch', np.repeat(epochs, n_times))
+    if conditions is not None:
+        df.insert(0, 'condition', np.repeat(conditions, n_times))
+    return(df)
+
+# ------------------------------------------------------------------------------
+# conditions
+# ------------------------------------------------------------------------------
+
+def condition_weights(epoch_conditions, conditions, difference_waves = ()):
+
+    # weights for averaging epochs as one matrix multiply, a row per output,
+    # the average of each condition and then each difference wave, which is
+    # (name, condition, condition subtracted). Returns the output names, the
+    # outputs x epochs weights and the number of averages of each output,
+    # for differences the same as mne.combine_evoked()
+    epoch_conditions = np.asarray(epoch_conditions)
+    one_hot = (epoch_conditions[np.newaxis] == np.array(conditions)[:, np.newaxis]).astype(np.float64)
+    naves = one_hot.sum(axis = 1)
+    rows = list(one_hot / naves[:, np.newaxis])
+    names = list(conditions)
+    nave_list = [int(n) for n in naves]
+
+    for name, condition, subtracted in difference_waves:
+        if condition in names and subtracted in names:
+            i, j = names.index(condition), names.index(subtracted)
+            rows.append(rows[i] - rows[j])
+            names.append(name)
+            nave_list.append(int(round(1. / (1. / nave_list[i] + 1. / nave_list[j]))))
+    return(names, np.array(rows).reshape(len(names), len(epoch_conditions)), nave_list)
+
+def average_conditions(data, weights):
+
+    # data is epochs x channels x times, returns outputs x channels x times
+    return((weights @ data.reshape(len(data), -1)).reshape((len(weights),) + data.shape[1:]))
+
+class ConditionsWriter(object):
+
+    # writes the file of export_conditions() a block of epochs at a time, so
+    # only one block is held in memory, csv rows are appended, parquet gets
+    # a row group per block and the npy array is filled in place.
+    # num_epochs is the number of epochs of all blocks together
+    def __init__(self, times, ch_names, fname, export_format, num_epochs):
+        if export_format not in export_formats:
+            raise ValueError('Unknown export format: ' + str(export_format))
+        self.times = times
+        self.ch_names = list(ch_names)
+        self.fname = fname
+        self.export_format = export_format
+        self.num_epochs = num_epochs
+        self.written = 0
+        self.conditions = []
+        self.epochs = []
+        self.parquet_writer = None
+        self.array = None
+        if export_format == 'npy':
+            self.array = np.lib.format.open_memmap(fname + '.npy', mode = 'w+', dtype = np.float32,
+                                                   shape = (num_epochs, len(self.ch_names), len(times)))
+
+    def write(self, data, conditions, epochs = None):
+
+        # data is epochs x channels x times in V, the next epochs of the file
+        if self.export_format == 'csv':
+            df = erp_data_frame(data, self.times, self.ch_names, epochs, conditions)
+            df.to_csv(self.fname + '.csv', index = False, mode = 'w' if self.written == 0 else 'a',
+                      header = self.written == 0)
+        elif self.export_format == 'parquet':
+            import pyarrow
+            import pyarrow.parquet
+            df = erp_data_frame(data, self.times, self.ch_names, epochs, conditions)
+            table = pyarrow.Table.from_pandas(df, preserve_index = False)
+            if self.parquet_writer is None:
+                self.parquet_writer = pyarrow.parquet.ParquetWriter(self.fname + '.parquet', table.schema)
+            self.parquet_writer.write_table(table)
+        else:
+            self.array[self.written:self.written + len(data)] = data * 1e6
+            self.conditions.extend(conditions)
+            self.epochs = None if epochs is None else self.epochs + [int(e) for e in epochs]
+        self.written = self.written + len(data)
+
+    def close(self):
+        if self.written != self.num_epochs:
+            raise ValueError(str(self.written) + ' epochs were written to ' + self.fname + ', expected ' + str(self.num_epochs))
+
+        # files without epochs still get their header
+        if self.written == 0 and self.export_format != 'npy':
+            self.write(np.zeros((0, len(self.ch_names), len(self.times))), [], [] if self.epochs is not None else None)
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+        if self.export_format == 'npy':
+            self.array.flush()
+            del self.array
+            sidecar = {
+             'dims': ['epoch', 'channel', 'time'],
+             'unit': 'uV',
+             'times': np.round(self.times * 1e3).astype(int).tolist(),
+             'ch_names': self.ch_names,
+             'epochs': self.epochs,
+             'conditions': list(self.conditions)
+            }
+            with open(self.fname + '.json', 'w') as f:
+                json.dump(sidecar, f)
+
+def export_conditions(data, times, ch_names, conditions, fname, export_format, epochs = None):
+
+    # averages or epochs of several conditions in one file, labeled by a
+    # condition column, in the same layout for all formats
+    writer = ConditionsWriter(times, ch_names, fname, export_format, len(data))
+    writer.write(data, conditions, epochs)
+    writer.close()
+
+# ------------------------------------------------------------------------------
+# readers
+# ------------------------------------------------------------------------------
+
+def read_erp_array(fname, mmap_mode = 'r'):
+
+    # returns the epochs x channels x times array and its sidecar
+    with open(fname + '.json', 'r') as f:
+        sidecar = json.load(f)
+    return(np.load(fname + '.npy', mmap_mode = mmap_mode), sidecar)
+
+def read_conditions(fname, export_format, ch_names):
+
+    # reads a file written by export_conditions() in any format, only the
+    # channels in ch_names. Returns the epochs x channels x times array in
+    # µV, the times in ms, and the condition and epoch number of each row
+    if export_format == 'npy':
+        data, sidecar = read_erp_array(fname)
+        picks = [sidecar['ch_names'].index(ch) for ch in ch_names]
+        epochs = sidecar['epochs'] if sidecar['epochs'] is not None else np.arange(len(data))
+        return(np.asarray(data[:, picks], dtype = np.float64), np.array(sidecar['times']),
+               np.array(sidecar['conditions']), np.array(epochs))
+
+    columns = ['condition', 'epoch', 'time'] + list(ch_names)
+    if export_format == 'parquet':
+        df = pd.read_parquet(fname + '.parquet', columns = columns)
+    elif export_format == 'csv':
+        df = pd.read_csv(fname + '.csv', usecols = columns)
+    else:
+        raise ValueError('Unknown export format: ' + str(export_format))
+
+    # rows are time points within epochs, in the order they were written
+    times = np.unique(df['time'].values)
+    n_times = len(times)
+    values = df[list(ch_names)].values.astype(np.float64)
+    data = values.reshape(-1, n_times, len(ch_names)).transpose(0, 2, 1)
+    return(data, times, df['condition'].values[::n_times], df['epoch'].values[::n_times])
@@ -0,0 +1,99 @@
+# ==============================================================================
+# ERP feature extraction functions
+#
+# ROI-averaged amplitude and latency measures for a set of time windows,
+# computed per trial and for the average directly from the epochs array.
+# Used by the pipeline to write one tidy feature table for the cohort.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+
+# ------------------------------------------------------------------------------
+# region of interest
+# ------------------------------------------------------------------------------
+
+def roi_average(data, ch_names, roi_channels):
+
+    # epochs x channels x times to epochs x times, averaged over the ROI
+    missing = [ch for ch in roi_channels if ch not in ch_names]
+    if len(missing) > 0:
+        raise ValueError('ROI channels not found in data: ' + ', '.join(missing))
+    picks = [ch_names.index(ch) for ch in roi_channels]
+    return(data[:, picks, :].mean(axis = 1))
+
+# ------------------------------------------------------------------------------
+# window measures
+# ------------------------------------------------------------------------------
+
+def window_features(roi, times, window_start, window_end, polarity):
+
+    # roi is rows x times (in µV, times in ms), all measures are computed
+    # for every row at once, polarity is 'positive' or 'negative'
+    mask = (times >= window_start) & (times <= window_end)
+    x = roi[:, mask]
+    t = times[mask]
+    rows = np.arange(x.shape[0])
+
+    # peak, the most positive or most negative point in the window
+    peak = np.argmax(x, axis = 1) if polarity == 'positive' else np.argmin(x, axis = 1)
+
+    # 50% fractional area latency, same definition as frac_fun() in the R
+    # helper functions, the area is taken relative to the opposite extreme
+    if polarity == 'positive':
+        shifted = x - x.min(axis = 1, keepdims = True)
+    else:
+        shifted = x - x.max(axis = 1, keepdims = True)
+    area = np.cumsum(shifted, axis = 1)
+    half = np.argmin(np.abs(area - area[:, -1:] / 2), axis = 1)
+
+    return({
+     'mean_amplitude': x.mean(axis = 1),
+     'peak_amplitude': x[rows, peak],
+     'peak_latency': t[peak],
+     'fractional_area_latency': t[half]
+    })
+
+# ------------------------------------------------------------------------------
+# extract features from epochs
+# ------------------------------------------------------------------------------
+
+def extract_features(epochs, roi_channels, windows, conditions):
+
+    # windows is a list of (component, start in s, end in s, polarity),
+    # returns one row per condition, component and trial, plus one row for
+    # the average over trials with trial set to 'average'
+    times = np.round(epochs.times * 1e3)
+    features = []
+
+    for condition in conditions:
+        if condition not in epochs.event_id:
+            continue
+
+        condition_epochs = epochs[condition]
+        roi = roi_average(condition_epochs.get_data(), condition_epochs.ch_names, roi_channels) * 1e6
+
+        # the ROI mean is linear, so averaging the ROI traces over trials gives
+        # the same trace as the ROI of the evoked data, and both are reduced
+        # in the same pass
+        roi = np.vstack([roi, roi.mean(axis = 0, keepdims = True)])
+        trials = [str(e) for e in condition_epochs.selection] + ['average']
+
+        for component, window_start, window_end, polarity in windows:
+            measures = window_features(roi, times, window_start * 1e3, window_end * 1e3, polarity)
+            df = pd.DataFrame(measures)
+            df.insert(0, 'trial', trials)
+            df.insert(0, 'component', component)
+            df.insert(0, 'condition', condition)
+            df.insert(3, 'num_trials', len(condition_epochs))
+            features.append(df)
+
+    if len(features) == 0:
+        return(pd.DataFrame(columns = ['condition', 'component', 'trial', 'num_trials',
+                                       'mean_amplitude', 'peak_amplitude', 'peak_latency',
+                                       'fractional_area_latency']))
+    return(pd.concat(features, ignore_index = True))
@@ -0,0 +1,211 @@
+# ==============================================================================
+# Incremental grand averages
+#
+# Running sum, sum of squares and count of the evoked data of every group
+# and condition, kept in one small .npz file that save_data updates as each
+# participant finishes. Grand averages, group differences and standard
+# errors are computed from it without reading the evoked files again.
+# Participants are grouped by the prefix of their ID, KON or RPK.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import os
+import contextlib
+import fcntl
+import numpy as np
+
+from . import config
+
+# ------------------------------------------------------------------------------
+# store
+# ------------------------------------------------------------------------------
+
+def participant_group(participantid):
+    return(participantid[:3])
+
+def store_key(group, condition, name):
+    return(group + '_' + condition + '_' + name)
+
+def evoked_file(participantid, condition):
+    return(config.evoked_data_outputdir + participantid + '_' + condition + '-ave.fif')
+
+def read_store(fname = None):
+
+    # dictionary of arrays, empty if nothing has been added yet
+    fname = config.grand_average_file if fname is None else fname
+    if not os.path.isfile(fname):
+        return({})
+    with np.load(fname, allow_pickle = False) as f:
+        return({key: f[key] for key in f.files})
+
+def write_store(store, fname):
+
+    # written next to the store and renamed, readers never see half a file
+    tmp_fname = fname + '.tmp.npz'
+    np.savez(tmp_fname, **store)
+    os.replace(tmp_fname, fname)
+
+@contextlib.contextmanager
+def locked_store(fname):
+
+    # participants finish in parallel, updates are serialized with a lock file
+    with open(fname + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield read_store(fname)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def add_evoked(participantid, condition, evoked, previous = None, fname = None):
+
+    # adds the evoked data of a participant to the sums of its group, if the
+    # participant was added before its previous evoked data, channels x
+    # times, is subtracted first so re-runs replace it. Without previous the
+    # sums of the group are rebuilt from the evoked files of the other
+    # participants
+    fname = config.grand_average_file if fname is None else fname
+    group = participant_group(participantid)
+    keys = {name: store_key(group, condition, name) for name in ['sum', 'sumsq', 'ids']}
+
+    with locked_store(fname) as store:
+        if 'times' in store:
+            if not np.allclose(store['times'], evoked.times) or list(store['ch_names']) != evoked.ch_names:
+                raise ValueError('Evoked data of ' + participantid + ' does not match the times and channels of ' + fname)
+        else:
+            store['times'] = evoked.times
+            store['ch_names'] = np.array(evoked.ch_names)
+            store['sfreq'] = np.array(evoked.info['sfreq'])
+
+        data = evoked.data.astype(np.float64)
+        if keys['sum'] not in store:
+            store[keys['sum']] = np.zeros_like(data)
+            store[keys['sumsq']] = np.zeros_like(data)
+            store[keys['ids']] = np.array([], dtype = str)
+
+        ids = list(store[keys['ids']])
+        if participantid in ids and previous is not None:
+            store[keys['sum']] -= previous
+            store[keys['sumsq']] -= previous ** 2
+        elif participantid in ids:
+            print('Warning:', participantid, 'is already in the', group, condition, 'grand average and its previous evoked data was not found, rebuilding the sums of', group)
+            ids.remove(participantid)
+            ids = rebuild_group(store, keys, ids, condition) + [participantid]
+        else:
+            ids.append(participantid)
+
+        store[keys['sum']] += data
+        store[keys['sumsq']] += data ** 2
+        store[keys['ids']] = np.array(sorted(ids))
+        write_store(store, fname)
+
+def remove_evoked(participantid, condition, fname = None):
+
+    # takes a participant out of the grand average of a condition and deletes
+    # its evoked file, for participants that no longer produce evoked data
+    # for it. The sums of the group are rebuilt from the evoked files of the
+    # participants left, a group without participants is dropped
+    fname = config.grand_average_file if fname is None else fname
+    group = participant_group(participantid)
+    keys = {name: store_key(group, condition, name) for name in ['sum', 'sumsq', 'ids']}
+
+    if os.path.isfile(evoked_file(participantid, condition)):
+        os.remove(evoked_file(participantid, condition))
+
+    with locked_store(fname) as store:
+        if keys['ids'] not in store or participantid not in list(store[keys['ids']]):
+            return
+        print('Removing participant', participantid, 'from the', group, condition, 'grand average')
+        ids = [other for other in store[keys['ids']] if other != participantid]
+        ids = rebuild_group(store, keys, ids, condition)
+        if len(ids) == 0:
+            for key in keys.values():
+                del store[key]
+        else:
+            store[keys['ids']] = np.array(sorted(ids))
+        write_store(store, fname)
+
+def store_participants(fname = None):
+
+    # (participant, condition) of every evoked data in the store
+    store = read_store(fname)
+    participants = []
+    for key in store:
+        if key.endswith('_ids'):
+            for participantid in store[key]:
+                condition = key[len(participant_group(participantid)) + 1:-len('_ids')]
+                participants.append((str(participantid), condition))
+    return(participants)
+
+def rebuild_group(store, keys, ids, condition):
+
+    # sums of a group from scratch from the evoked files of the participants
+    # in ids, in evoked_data_outputdir, participants without a file are left
+    # out. Returns the participants that were added
+    import mne
+    store[keys['sum']][:] = 0.
+    store[keys['sumsq']][:] = 0.
+    added = []
+    for participantid in ids:
+        if not os.path.isfile(evoked_file(participantid, condition)):
+            print('Warning: evoked data of', participantid, 'not found, it is left out of the', condition, 'grand average')
+            continue
+        data = mne.read_evokeds(evoked_file(participantid, condition), condition = condition, proj = True, verbose = None).data
+        store[keys['sum']] += data
+        store[keys['sumsq']] += data ** 2
+        added.append(participantid)
+    return(added)
+
+def build_store(evoked_files, condition, fname = None):
+
+    # builds the store from scratch from saved evoked files, named ID_condition-ave.fif
+    import mne
+    fname = config.grand_average_file if fname is None else fname
+    if os.path.isfile(fname):
+        os.remove(fname)
+    for file in sorted(evoked_files):
+        participantid = config.file_splitter(file)
+        evoked = mne.read_evokeds(file, condition = condition, proj = True, verbose = None)
+        add_evoked(participantid, condition, evoked, fname = fname)
+
+# ------------------------------------------------------------------------------
+# grand averages
+# ------------------------------------------------------------------------------
+
+def grand_average(group, condition, fname = None, store = None):
+
+    # mean and standard error over the participants of a group, channels x
+    # times in V, and the number of participants
+    store = read_store(fname) if store is None else store
+    if store_key(group, condition, 'sum') not in store:
+        raise KeyError('No ' + condition + ' evoked data of group ' + group + ' in the grand average store')
+
+    n = len(store[store_key(group, condition, 'ids')])
+    total = store[store_key(group, condition, 'sum')]
+    mean = total / n
+    if n > 1:
+        variance = (store[store_key(group, condition, 'sumsq')] - total * mean) / (n - 1)
+        se = np.sqrt(np.clip(variance, 0, None) / n)
+    else:
+        se = np.full_like(mean, np.nan)
+    return(mean, se, n)
+
+def group_difference(group, reference, condition, fname = None, store = None):
+
+    # difference of the grand averages, group minus reference, and its
+    # standard error for independent groups
+    store = read_store(fname) if store is None else store
+    mean, se, n = grand_average(group, condition, store = store)
+    reference_mean, reference_se, reference_n = grand_average(reference, condition, store = store)
+    return(mean - reference_mean, np.sqrt(se ** 2 + reference_se ** 2))
+
+def grand_average_evoked(group, condition, info, fname = None, store = None):
+
+    # the grand average as an mne.EvokedArray, for plotting, info must have
+    # the channels of the store
+    import mne
+    store = read_store(fname) if store is None else store
+    mean, se, n = grand_average(group, condition, store = store)
+    return(mne.EvokedArray(mean, info, tmin = float(store['times'][0]), comment = group + ' ' + condition, nave = n))
@@ -0,0 +1,119 @@
+# ==============================================================================
+# ICA cleaning matrix
+#
+# ica.apply() takes the data through the pre-whitening, PCA and unmixing to
+# the sources, zeroes the excluded ones and mixes back. Every step is linear
+# apart from the PCA mean, so the whole chain is one channels x channels
+# matrix and an offset per channel. Both are found once per participant by
+# applying the ICA to a zero and to an identity signal, cached with the hash
+# of the ICA file and applied in place, to raw data or to epochs, a block of
+# samples at a time.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import os
+import numpy as np
+
+from . import config
+
+# ------------------------------------------------------------------------------
+# cleaning matrix
+# ------------------------------------------------------------------------------
+
+# samples cleaned at a time, 32768 samples of 128 channels are 32 MB
+chunk_samples = 2**15
+
+def ica_file(participantid):
+    return(config.ica_inputdir + participantid + '_ica.fif')
+
+def cleaning_matrix_file(participantid):
+    return(config.cache_outputdir + participantid + '_ica_cleaning.npz')
+
+def compute_cleaning_matrix(ica, info):
+
+    # the first probe sample is zero and gives the offset, the others are
+    # one at a single channel each and give the columns of the matrix
+    import mne
+
+    picks = [info['ch_names'].index(ch) for ch in ica.ch_names]
+    n_channels = len(picks)
+    probe = np.hstack([np.zeros((n_channels, 1)), np.eye(n_channels)])
+    probe_raw = mne.io.RawArray(probe, mne.pick_info(info, picks), verbose = False)
+    ica.apply(probe_raw)
+
+    cleaned = probe_raw.get_data()
+    offset = cleaned[:, 0]
+    matrix = cleaned[:, 1:] - offset[:, None]
+    return(matrix, offset)
+
+def cleaning_matrix(participantid, info):
+
+    # the cached matrix if it was made from the same ICA file, otherwise it
+    # is computed and cached, info has to have the channels of the ICA
+    from .cache import file_hash
+    import mne
+
+    ica_hash = file_hash(ica_file(participantid))
+    fname = cleaning_matrix_file(participantid)
+    if os.path.isfile(fname):
+        with np.load(fname, allow_pickle = False) as f:
+            if str(f['ica_hash']) == ica_hash:
+                return({'matrix': f['matrix'], 'offset': f['offset'],
+                        'ch_names': list(f['ch_names']), 'num_excluded': int(f['num_excluded'])})
+
+    ica = mne.preprocessing.read_ica(ica_file(participantid))
+    matrix, offset = compute_cleaning_matrix(ica, info)
+    cleaning = {'matrix': matrix, 'offset': offset, 'ch_names': list(ica.ch_names), 'num_excluded': len(ica.exclude)}
+
+    # written next to the cache file and renamed, as parallel runs may read it
+    tmp_fname = fname + '.tmp.' + str(os.getpid()) + '.npz'
+    np.savez(tmp_fname, ica_hash = np.array(ica_hash), ch_names = np.array(cleaning['ch_names']),
+             matrix = matrix, offset = offset, num_excluded = np.array(cleaning['num_excluded']))
+    os.replace(tmp_fname, fname)
+    return(cleaning)
+
+# ------------------------------------------------------------------------------
+# apply
+# ------------------------------------------------------------------------------
+
+def apply_cleaning_matrix(data, ch_names, cleaning, offset = True):
+
+    # data is channels x times or epochs x channels x times and is cleaned in
+    # place, channels that are not in the ICA are left as they are. The
+    # offset is constant over time, so it is left out for baseline corrected
+    # epochs, where it would be removed by the baseline again
+    picks = [ch_names.index(ch) for ch in cleaning['ch_names']]
+    matrix = cleaning['matrix']
+    shift = cleaning['offset'][:, None] if offset else 0.
+
+    if data.ndim == 2:
+        for start in range(0, data.shape[1], chunk_samples):
+            data[picks, start:start + chunk_samples] = matrix @ data[picks, start:start + chunk_samples] + shift
+    else:
+        num_epochs = max(1, chunk_samples // data.shape[2])
+        for start in range(0, len(data), num_epochs):
+            chunk = data[start:start + num_epochs]
+            chunk[:, picks] = matrix @ chunk[:, picks] + shift
+
+def clean_data(participantid, inst, offset = True):
+
+    # removes the excluded components from preloaded raw data or epochs in
+    # place, returns the number of components removed. Without offset the
+    # result of ica.apply() is shifted back by the cleaned zero signal, so
+    # both ways give the same data
+    if not config.ica_cleaning_matrix:
+        import mne
+        ica = mne.preprocessing.read_ica(ica_file(participantid))
+        ica.apply(inst)
+        if not offset:
+            shift = compute_cleaning_matrix(ica, inst.info)[1]
+            picks = [inst.ch_names.index(ch) for ch in ica.ch_names]
+            inst._data[..., picks, :] -= shift[:, None]
+        return(len(ica.exclude))
+
+    cleaning = cleaning_matrix(participantid, inst.info)
+    apply_cleaning_matrix(inst._data, inst.ch_names, cleaning, offset)
+    return(cleaning['num_excluded'])
@@ -0,0 +1,292 @@
+# ==============================================================================
+# Pipeline
+#
+# Runs the stages for one participant, resuming from the stage cache, and
+# for a batch of participants in parallel.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+# MNE and pandas are only loaded by the functions that run stages or
+# merge their results, so run_batch can be imported by a coordinator that
+# hands all the work to queue or cluster workers
+import os
+import time
+
+from . import config
+from .config import file_splitter
+from .errors import PreprocessingError, StageError, failure_record, update_failures
+from .events import count_epochs
+from .grand_average import remove_evoked, store_participants
+from .profiling import profile_stage, summarize_profiles
+from .runlog import set_queue, log_record, read_log
+from .scheduler import inner_jobs
+
+# ------------------------------------------------------------------------------
+# select functions
+# ------------------------------------------------------------------------------
+
+def profile_file(participantid, stage):
+
+    # file name for the cProfile/pyinstrument dump of a stage, without extension
+    if config.stage_profiler is None:
+        return(None)
+    return(config.profile_outputdir + participantid + '_' + stage)
+
+def evoked_names():
+
+    # every evoked output of save_data, the conditions and the difference waves
+    return(list(config.export_conditions) + [name for name, condition, subtracted in config.difference_waves])
+
+def epochs_store_file(participantid):
+    return(config.epochs_store_outputdir + participantid + '_cleaned')
+
+def epochs_store_key(keys):
+
+    # the store is reused for the same inputs to the last stage and precision
+    return(keys[config.stages[-1]] + '_' + config.epochs_store_dtype)
+
+def store_epochs(participantid, epochs, key = None):
+
+    # writes the cleaned epochs to the store and returns the store opened as
+    # a memory map in their place, so the epochs can be freed
+    from .epochs_store import write_epochs_store, read_epochs_store
+
+    precision = write_epochs_store(epochs, epochs_store_file(participantid), config.epochs_store_dtype, 
+                                   config.epochs_store_tolerance, key)
+    log_record('store', participantid, dict(precision, dtype = config.epochs_store_dtype))
+    return(read_epochs_store(epochs_store_file(participantid)))
+
+def run_stage(stage, participant, data, scheduler, allocation_log):
+    from .stages import prepare_data, filter_data, apply_ica, epoch_data, autoreject_data
+
+    if stage == 'prepare':
+        return(prepare_data(participant))
+    elif stage == 'filter':
+        with inner_jobs(scheduler, allocation_log, stage) as njobs:
+            return(filter_data(participant, data, njobs))
+    elif stage == 'ica':
+        return(apply_ica(participant, data))
+    elif stage == 'epoch':
+        return(epoch_data(participant, data))
+    elif stage == 'autoreject':
+        with inner_jobs(scheduler, allocation_log, stage) as njobs:
+            return(autoreject_data(participant, njobs, config.ar_threshold, config.autoreject_cv, config.autoreject_random_state, data))
+
+def run_preprocess(participant, scheduler = None, settings = None, log_queue = None):
+
+    # workers import a fresh config, so the settings of the parent are handed
+    # over, and send their logs to the writer in the parent
+    from .cache import stage_keys, cache_file, read_cache, write_cache
+    from .epochs_store import EpochsStore, read_epochs_store, read_epochs_store_key
+    from .stages import save_data, feature_data
+
+    if settings is not None:
+        config.apply(settings)
+    if log_queue is not None:
+        set_queue(log_queue)
+
+    # start timer
+    start = time.time()
+
+    file = config.data_inputdir + participant
+    participantid = file_splitter(file)
+
+    print('Preproccesing participant', participantid)
+
+    # one profile record per stage run, including reading the cache
+    profile_log = []
+
+    # resume from the last stage with an up to date cached result, if any,
+    # stage logs from the run that produced the cached result are kept
+    data = None
+    first_stage = 0
+    allocation_log = []
+    features = None
+
+    # errors are raised as a StageError of the stage they happened in
+    current_stage = 'cache'
+    try:
+        if config.use_cache:
+            keys = stage_keys(participant)
+
+            # the epochs store of the last stage is used as is when it came from
+            # the same inputs, without reading the cached epochs
+            if config.epochs_store and read_epochs_store_key(epochs_store_file(participantid)) == epochs_store_key(keys):
+                print('Using stored', config.stages[-1], 'data for participant', participantid)
+                with profile_stage('cache', profile_log, config.stage_profiler, profile_file(participantid, 'cache')):
+                    data = read_epochs_store(epochs_store_file(participantid))
+                first_stage = len(config.stages)
+            else:
+                for i in reversed(range(len(config.stages))):
+                    if config.stages[i] in config.cached_stages and os.path.isfile(cache_file(participantid, config.stages[i], keys[config.stages[i]])):
+                        print('Using cached', config.stages[i], 'data for participant', participantid)
+                        with profile_stage('cache', profile_log, config.stage_profiler, profile_file(participantid, 'cache')):
+                            data = read_cache(participantid, config.stages[i], keys[config.stages[i]])
+                        first_stage = i + 1
+                        break
+
+        # functions, each stage hands its data directly to the next one
+        for stage in config.stages[first_stage:]:
+            current_stage = stage
+            with profile_stage(stage, profile_log, config.stage_profiler, profile_file(participantid, stage)) as record:
+                data = run_stage(stage, participant, data, scheduler, allocation_log)
+                if config.use_cache and stage in config.cached_stages:
+                    write_cache(participantid, stage, keys[stage], data)
+
+                # inner_jobs() logs the n_jobs of the stages that use them
+                if len(allocation_log) > 0 and allocation_log[-1]['stage'] == stage:
+                    record['n_jobs'] = allocation_log[-1]['n_jobs']
+
+        # the cleaned epochs are replaced by the memory-mapped store
+        if config.epochs_store and not isinstance(data, EpochsStore):
+            current_stage = 'store'
+            with profile_stage('store', profile_log, config.stage_profiler, profile_file(participantid, 'store')):
+                data = store_epochs(participantid, data, epochs_store_key(keys) if config.use_cache else None)
+
+        # only keep participants with enough correct nogo trials left after AR
+        saved = []
+        if count_epochs(data, ['nogocorr'])['nogocorr'] >= config.ar_threshold:
+            current_stage = 'save'
+            with profile_stage('save', profile_log, config.stage_profiler, profile_file(participantid, 'save')):
+                saved = save_data(participant, data)
+            current_stage = 'features'
+            with profile_stage('features', profile_log, config.stage_profiler, profile_file(participantid, 'features')):
+                features = feature_data(participant, data)
+
+        # evoked data of an earlier run that this one did not produce, too few
+        # trials left after AR or no epochs of a condition, is taken out of
+        # the grand averages
+        current_stage = 'save'
+        for name in evoked_names():
+            if name not in saved:
+                remove_evoked(participantid, name)
+
+    except PreprocessingError:
+        raise
+    except Exception as error:
+        raise StageError(participantid, current_stage, error) from error
+
+    # hand this participant's share of the cores to those still running
+    finally:
+        if scheduler is not None:
+            scheduler.finish_job()
+
+    # stop timer
+    end = time.time()
+    print('Done! Preprocessing took', round((end-start) / 60, 2), 'minutes to complete for participant', participantid)
+
+    # save timer log
+    timer_log = {
+     'ID': participantid, 
+     'preprocessing_time_in_minutes': round((end-start) / 60, 2)
+    }
+
+    log_record('timer', participantid, timer_log)
+
+    # save core allocation log, one row per stage that used inner n_jobs
+    if len(allocation_log) > 0:
+        log_record('cores', participantid, {'stages': allocation_log})
+
+    # save profile log, one row per stage
+    log_record('profile', participantid, {'stages': profile_log})
+
+    return(features)
+
+def run_isolated(participant, scheduler = None, settings = None, log_queue = None):
+
+    # run_preprocess for one participant of a batch, an error is returned as
+    # part of the outcome instead of raised, so the others carry on
+    try:
+        features = run_preprocess(participant, scheduler, settings, log_queue)
+    except Exception as error:
+        failure = failure_record(error, file_splitter(participant))
+        print('Failed participant', failure['ID'], 'in stage', failure['stage'], '-', failure['error'] + ':', failure['message'])
+        log_record('failure', failure['ID'], failure)
+        return({'participant': participant, 'features': None, 'error': failure})
+    return({'participant': participant, 'features': features, 'error': None})
+
+def run_batch(files, executor = None, merge_features = False):
+
+    # run all participants in files with one of the executors, the batch,
+    # feature and profile logs and the failure manifest are written when all
+    # are done, merge_features keeps the features of participants not in files
+    import pandas as pd
+    from .executors import executors
+
+    batch_start = time.time()
+    executor = config.executor if executor is None else executor
+
+    if config.stage_profiler is not None:
+        os.makedirs(config.profile_outputdir, exist_ok = True)
+
+    outcomes = executors[executor](files)
+    failures = update_failures(outcomes)
+
+    # participants that failed or are no longer in the input have no evoked
+    # data, they are taken out of the grand averages
+    failed = [file_splitter(outcome['participant']) for outcome in outcomes if outcome['error'] is not None]
+    inputids = [file_splitter(participant) for participant in config.participant_files()]
+    for participantid, condition in store_participants():
+        if participantid in failed or participantid not in inputids:
+            remove_evoked(participantid, condition)
+
+    # save ERP features of all included participants as one table
+    features = [outcome['features'] for outcome in outcomes if outcome['features'] is not None]
+    features_fname = config.averaged_data_outputdir + 'erp_features' + '.csv'
+    if merge_features and os.path.isfile(features_fname):
+        previous = pd.read_csv(features_fname)
+        participantids = [file_splitter(participant) for participant in files]
+        features = [previous[~previous['ID'].isin(participantids)]] + features
+
+    features_df = None
+    if len(features) > 0:
+        features_df = pd.concat(features, ignore_index = True)
+        features_df.to_csv(features_fname, index = False)
+
+    # save batch log, to compare wall-clock time between core settings
+    batch_end = time.time()
+    print('Batch of', len(files), 'participants took', round((batch_end - batch_start) / 60, 2), 'minutes to complete')
+    if len(failures) > 0:
+        print(len(failures), 'participants failed:', ' '.join(sorted(failures)), 
+              '(see', config.failure_manifest_file + ', rerun them with --rerun-failed)')
+
+    batch_log = {
+     'num_participants': len(files), 
+     'executor': executor, 
+     'parallel_cores': config.parallel_cores, 
+     'total_cores': config.total_cores, 
+     'num_failed': sum(outcome['error'] is not None for outcome in outcomes), 
+     'batch_time_in_minutes': round((batch_end - batch_start) / 60, 2)
+    }
+
+    log_record('batch', None, batch_log)
+
+    # summary per stage of the profiles of every participant in this batch
+    participantids = [file_splitter(participant) for participant in files]
+    profile_rows = [dict(stage, ID = record['ID']) for record in read_log('profile', participantids) for stage in record['stages']]
+    if len(profile_rows) > 0:
+        summarize_profiles(pd.DataFrame(profile_rows)).to_csv(config.log_outputdir + 'profile_summary' + '.csv', index = False)
+
+    return(features_df)
+
+def run_single_stage(stage, participant, settings = None, log_queue = None):
+
+    # runs one stage on the checkpoint saved by the stage before it in an
+    # earlier run, and saves a checkpoint of its own
+    from .stages import save_data
+
+    if settings is not None:
+        config.apply(settings)
+    if log_queue is not None:
+        set_queue(log_queue)
+
+    config.save_checkpoints = True
+    if stage == 'save':
+        save_data(participant)
+    else:
+        data = run_stage(stage, participant, None, None, [])
+        if stage == config.stages[-1] and config.epochs_store:
+            store_epochs(file_splitter(participant), data)
@@ -0,0 +1,142 @@
+# ==============================================================================
+# Stage profiling functions
+#
+# A context manager recording wall time, CPU time, peak resident memory and
+# bytes read and written for each preprocessing stage, used by
+# the pipeline. Optionally dumps a cProfile or pyinstrument profile
+# per stage.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import contextlib
+import resource
+import time
+
+# ------------------------------------------------------------------------------
+# process counters
+# ------------------------------------------------------------------------------
+
+def cpu_time():
+
+    # user and system time of this process and of its waited-for children,
+    # workers of a persistent pool (e.g. loky) are not included
+    self = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return(self.ru_utime + self.ru_stime + children.ru_utime + children.ru_stime)
+
+def reset_peak_rss():
+
+    # resets the peak RSS of this process to its current RSS (Linux only),
+    # returns False if that is not possible
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return(True)
+    except OSError:
+        return(False)
+
+def peak_rss():
+
+    # peak resident memory in MB, since the last reset if supported,
+    # otherwise since the process started
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return(int(line.split()[1]) / 1024)
+    except OSError:
+        pass
+    return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+def io_bytes():
+
+    # bytes read and written through read/write calls, including reads
+    # served from the page cache, None if /proc/self/io is not available
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return(int(counters['rchar']), int(counters['wchar']))
+    except (OSError, KeyError, ValueError):
+        return(None, None)
+
+# ------------------------------------------------------------------------------
+# stage profiler
+# ------------------------------------------------------------------------------
+
+@contextlib.contextmanager
+def profile_stage(stage, profile_log, profiler = None, profile_file = None):
+
+    # appends one record to profile_log when the stage is done, the record is
+    # yielded so the caller can add to it, e.g. the n_jobs used
+    record = {'stage': stage, 'n_jobs': 1}
+
+    if profiler == 'cprofile':
+        import cProfile
+        stage_profiler = cProfile.Profile()
+    elif profiler == 'pyinstrument':
+        import pyinstrument
+        stage_profiler = pyinstrument.Profiler()
+    elif profiler is not None:
+        raise ValueError('Unknown profiler: ' + str(profiler))
+
+    peak_reset = reset_peak_rss()
+    read_start, write_start = io_bytes()
+    cpu_start = cpu_time()
+    wall_start = time.perf_counter()
+
+    if profiler == 'cprofile':
+        stage_profiler.enable()
+    elif profiler == 'pyinstrument':
+        stage_profiler.start()
+
+    try:
+        yield record
+
+    finally:
+        if profiler == 'cprofile':
+            stage_profiler.disable()
+            stage_profiler.dump_stats(profile_file + '.prof')
+        elif profiler == 'pyinstrument':
+            stage_profiler.stop()
+            with open(profile_file + '.html', 'w') as f:
+                f.write(stage_profiler.output_html())
+
+        wall_end = time.perf_counter()
+        cpu_end = cpu_time()
+        read_end, write_end = io_bytes()
+
+        record.update({
+         'wall_time_in_seconds': round(wall_end - wall_start, 3),
+         'cpu_time_in_seconds': round(cpu_end - cpu_start, 3),
+         'peak_rss_in_mb': round(peak_rss(), 1),
+         'peak_rss_since_start': not peak_reset,
+         'mb_read': None if read_start is None else round((read_end - read_start) / 1e6, 2),
+         'mb_written': None if write_start is None else round((write_end - write_start) / 1e6, 2)
+        })
+        profile_log.append(record)
+
+# ------------------------------------------------------------------------------
+# cohort summary
+# ------------------------------------------------------------------------------
+
+def summarize_profiles(profile_df):
+
+    # one row per stage over all participants
+    summary = profile_df.groupby('stage', sort = False).agg(
+        num_participants = ('ID', 'nunique'),
+        mean_wall_time_in_seconds = ('wall_time_in_seconds', 'mean'),
+        max_wall_time_in_seconds = ('wall_time_in_seconds', 'max'),
+        total_wall_time_in_seconds = ('wall_time_in_seconds', 'sum'),
+        total_cpu_time_in_seconds = ('cpu_time_in_seconds', 'sum'),
+        max_peak_rss_in_mb = ('peak_rss_in_mb', 'max'),
+        total_mb_read = ('mb_read', 'sum'),
+        total_mb_written = ('mb_written', 'sum'),
+        mean_n_jobs = ('n_jobs', 'mean')
+    ).round(3).reset_index()
+
+    # share of the summed stage time, to see where the time goes
+    summary['perc_wall_time'] = round(summary['total_wall_time_in_seconds'] / summary['total_wall_time_in_seconds'].sum() * 100, 1)
+    return(summary)
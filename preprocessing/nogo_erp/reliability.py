@@ -0,0 +1,174 @@
+# ==============================================================================
+# Split-half reliability
+#
+# Reliability of the ERP features over many random split-halves of the
+# single-trial data written by save_data, instead of one odd/even split.
+# For each participant, the ROI traces of both halves of every split are
+# averaged with one matrix multiply, the features of all splits are
+# computed together, and the correlation over participants is taken for
+# each split and Spearman-Brown corrected. Splits are run in chunks in
+# parallel, each chunk with its own seed derived from reliability_seed, so
+# the result does not depend on the number of cores.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import os
+import numpy as np
+import pandas as pd
+
+from . import config
+from .config import file_splitter
+from .export import export_extensions, read_conditions
+from .features import roi_average, window_features
+
+# ------------------------------------------------------------------------------
+# data
+# ------------------------------------------------------------------------------
+
+def read_roi_trials(condition, roi_channels, export_format = None):
+
+    # ROI traces of the single trials of condition for each participant, in
+    # µV, from output/raw_data/, participants with fewer than two trials
+    # cannot be split and are left out. Returns the participant IDs, lists
+    # of trials x times arrays and of epoch numbers, ordered by epoch
+    # number, and the times in ms
+    export_format = config.export_format if export_format is None else export_format
+    extension = export_extensions[export_format][0]
+    suffix = '_conditions_raw' + extension
+
+    participantids, rois, epoch_numbers, times = [], [], [], None
+    for fname in sorted(os.listdir(config.raw_averaged_data_outputdir)):
+        if not fname.endswith(suffix):
+            continue
+        data, times, conditions, epochs = read_conditions(config.raw_averaged_data_outputdir + fname[:-len(extension)],
+                                                          export_format, roi_channels)
+        selected = np.flatnonzero(conditions == condition)
+        selected = selected[np.argsort(epochs[selected], kind = 'stable')]
+        if len(selected) < 2:
+            continue
+        participantids.append(file_splitter(fname))
+        rois.append(roi_average(data[selected], list(roi_channels), roi_channels))
+        epoch_numbers.append(epochs[selected])
+    return(participantids, rois, epoch_numbers, times)
+
+# ------------------------------------------------------------------------------
+# splits
+# ------------------------------------------------------------------------------
+
+def random_halves(rng, num_splits, num_trials):
+
+    # splits x trials, True for the trials in the first half, half of the
+    # trials (rounded down) are drawn without replacement for each split
+    order = np.argsort(rng.random((num_splits, num_trials)), axis = 1)
+    first = np.zeros((num_splits, num_trials), dtype = bool)
+    np.put_along_axis(first, order[:, :num_trials // 2], True, axis = 1)
+    return(first)
+
+def odd_even_halves(epochs):
+
+    # the fixed split of the R analysis, odd and even epoch numbers
+    return((np.asarray(epochs) % 2 == 1)[np.newaxis])
+
+def half_features(rois, halves, times, windows):
+
+    # features of both halves of every split for every participant,
+    # {(component, measure): splits x participants x 2}, halves is a list of
+    # splits x trials masks, one per participant
+    features = {}
+    for p, (roi, first) in enumerate(zip(rois, halves)):
+        weights = np.concatenate([first / first.sum(axis = 1, keepdims = True),
+                                  ~first / (~first).sum(axis = 1, keepdims = True)])
+        averages = weights @ roi
+        num_splits = len(first)
+
+        for component, window_start, window_end, polarity in windows:
+            measures = window_features(averages, times, window_start * 1e3, window_end * 1e3, polarity)
+            for measure, values in measures.items():
+                key = (component, measure)
+                if key not in features:
+                    features[key] = np.empty((num_splits, len(rois), 2))
+                features[key][:, p, 0] = values[:num_splits]
+                features[key][:, p, 1] = values[num_splits:]
+    return(features)
+
+def split_correlations(features):
+
+    # Pearson correlation over participants of the two halves, per split,
+    # nan if a half does not vary over participants
+    correlations = {}
+    for key, values in features.items():
+        centered = values - values.mean(axis = 1, keepdims = True)
+        covariance = (centered[:, :, 0] * centered[:, :, 1]).sum(axis = 1)
+        scale = np.sqrt((centered[:, :, 0] ** 2).sum(axis = 1) * (centered[:, :, 1] ** 2).sum(axis = 1))
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            correlations[key] = covariance / scale
+    return(correlations)
+
+def spearman_brown(r):
+    return(2 * r / (1 + r))
+
+def run_chunk(rois, times, windows, seed, num_splits):
+
+    # correlations of num_splits random splits, run in a worker
+    rng = np.random.default_rng(seed)
+    halves = [random_halves(rng, num_splits, len(roi)) for roi in rois]
+    return(split_correlations(half_features(rois, halves, times, windows)))
+
+# ------------------------------------------------------------------------------
+# reliability
+# ------------------------------------------------------------------------------
+
+def split_half_reliability(rois, epochs, times, windows, num_splits = 5000, seed = 42, chunk_size = 500, n_jobs = 1):
+
+    # one row per component and measure, with the Spearman-Brown corrected
+    # correlation of the odd/even split and the median and 90% interval
+    # over the random splits
+    from mne.parallel import parallel_func
+
+    chunks = [chunk_size] * (num_splits // chunk_size) + ([num_splits % chunk_size] if num_splits % chunk_size > 0 else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    parallel, run_func, _ = parallel_func(run_chunk, n_jobs = n_jobs, total = None)
+    results = parallel(run_func(rois, times, windows, chunk_seed, chunk_splits) for chunk_seed, chunk_splits in zip(seeds, chunks))
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        odd_even = split_correlations(half_features(rois, [odd_even_halves(e) for e in epochs], times, windows))
+
+    rows = []
+    for key in odd_even:
+        rho = spearman_brown(np.concatenate([result[key] for result in results]))
+        rho = rho[np.isfinite(rho)]
+        rows.append({
+         'component': key[0],
+         'measure': key[1],
+         'num_participants': len(rois),
+         'num_splits': len(rho),
+         'rho_sb_odd_even': float(spearman_brown(odd_even[key][0])),
+         'rho_sb_mean': float(rho.mean()) if len(rho) > 0 else np.nan,
+         'rho_sb_median': float(np.median(rho)) if len(rho) > 0 else np.nan,
+         'rho_sb_lower_90': float(np.percentile(rho, 5)) if len(rho) > 0 else np.nan,
+         'rho_sb_upper_90': float(np.percentile(rho, 95)) if len(rho) > 0 else np.nan
+        })
+    return(pd.DataFrame(rows))
+
+def run_reliability(condition = None, fname = None):
+
+    # reliability of the features of config.feature_windows in the ROI, for
+    # the single trials in output/raw_data/, written to output/data/
+    condition = config.reliability_condition if condition is None else condition
+    fname = config.reliability_file if fname is None else fname
+
+    participantids, rois, epochs, times = read_roi_trials(condition, config.roi_channels)
+    if len(participantids) < 3:
+        raise ValueError('Split-half reliability needs at least three participants with ' + condition + ' trials, found ' + str(len(participantids)))
+
+    reliability = split_half_reliability(rois, epochs, times, config.feature_windows,
+                                         num_splits = config.reliability_splits,
+                                         seed = config.reliability_seed,
+                                         chunk_size = config.reliability_chunk_size,
+                                         n_jobs = config.parallel_cores)
+    reliability.insert(0, 'condition', condition)
+    reliability.to_csv(fname, index = False)
+    return(reliability)
@@ -0,0 +1,166 @@
+# ==============================================================================
+# Run logging
+#
+# Stage logs are plain dictionaries, one per participant and log. Workers
+# put them on a queue and a single writer thread in the main process
+# appends them in batches to one JSON lines cohort log, keyed by
+# participant ID and log name. Re-runs append, readers keep the latest
+# record for each ID and log.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+import contextlib
+import json
+import queue
+import threading
+import time
+
+from . import config
+
+# ------------------------------------------------------------------------------
+# records
+# ------------------------------------------------------------------------------
+
+# queue to the writer, set in each worker, records are written directly to
+# the cohort log when there is no writer
+log_queue = None
+
+# put on the queue to stop the writer
+stop_record = 'stop'
+
+def set_queue(current_queue):
+    global log_queue
+    log_queue = current_queue
+
+def json_value(value):
+
+    # numpy scalars, tuples and lists of records as plain JSON values
+    if hasattr(value, 'item'):
+        return(value.item())
+    if isinstance(value, (tuple, list)):
+        return([json_value(v) for v in value])
+    if isinstance(value, dict):
+        return({k: json_value(v) for k, v in value.items()})
+    return(value)
+
+def make_record(log, participantid, record):
+    entry = {'log': log, 'ID': participantid, 'time': round(time.time(), 3)}
+    entry.update({key: json_value(value) for key, value in record.items() if key != 'ID'})
+    return(entry)
+
+def write_records(records, fname):
+    lines = ''.join(json.dumps(record) + '\n' for record in records)
+    with open(fname, 'a', encoding = 'utf-8') as f:
+        f.write(lines)
+
+def log_record(log, participantid, record):
+
+    # one record per participant and log, e.g.
+    # log_record('filter', 'KON001', {'num_bad_channels_interpolated': 2}),
+    # logs with a row per stage keep them as a list
+    entry = make_record(log, participantid, record)
+    if log_queue is not None:
+        log_queue.put(entry)
+    else:
+        write_records([entry], config.cohort_log_file)
+
+# ------------------------------------------------------------------------------
+# writer
+# ------------------------------------------------------------------------------
+
+class LogWriter(threading.Thread):
+
+    # collects records from the queue and appends them to fname, whenever
+    # batch_size records are waiting or every interval seconds
+    def __init__(self, records, fname, batch_size = 100, interval = 1.):
+        threading.Thread.__init__(self, daemon = True)
+        self.records = records
+        self.fname = fname
+        self.batch_size = batch_size
+        self.interval = interval
+
+    def run(self):
+        buffer = []
+        last_write = time.time()
+        finished = False
+
+        while not finished:
+            try:
+                record = self.records.get(timeout = self.interval)
+                if record == stop_record:
+                    finished = True
+                else:
+                    buffer.append(record)
+            except queue.Empty:
+                pass
+
+            if len(buffer) > 0 and (finished or len(buffer) >= self.batch_size or time.time() - last_write >= self.interval):
+                write_records(buffer, self.fname)
+                buffer = []
+                last_write = time.time()
+
+    def stop(self):
+        self.records.put(stop_record)
+        self.join()
+
+@contextlib.contextmanager
+def log_writer(manager):
+
+    # yields a queue for the workers, everything put on it is written by
+    # the time the context exits
+    records = manager.Queue()
+    writer = LogWriter(records, config.cohort_log_file)
+    writer.start()
+    set_queue(records)
+    try:
+        yield records
+    finally:
+        set_queue(None)
+        writer.stop()
+
+# ------------------------------------------------------------------------------
+# reader
+# ------------------------------------------------------------------------------
+
+def read_log(log, participantids = None, fname = None):
+
+    # latest record of a log for each participant, as a list of dictionaries
+    fname = config.cohort_log_file if fname is None else fname
+    latest = {}
+    if not os.path.isfile(fname):
+        return([])
+
+    with open(fname, 'r', encoding = 'utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if record['log'] == log and (participantids is None or record['ID'] in participantids):
+                latest[record['ID']] = record
+    return(list(latest.values()))
+
+# ------------------------------------------------------------------------------
+# session info
+# ------------------------------------------------------------------------------
+
+class Logger(object):
+
+    # copies stdout to fname, the file is opened once and written through
+    # a buffer that is flushed with stdout
+    def __init__(self, fname):
+        self.terminal = sys.stdout
+        self.log = open(fname, 'a', encoding = 'utf-8')
+
+    def write(self, message):
+        self.log.write(message)
+        self.terminal.write(message)
+
+    def flush(self):
+        self.log.flush()
+        self.terminal.flush()
+
+    def close(self):
+        self.log.close()
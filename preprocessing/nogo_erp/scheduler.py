@@ -0,0 +1,67 @@
+# ==============================================================================
+# Core scheduler
+#
+# Shares a core budget between the participants run in parallel and the
+# n_jobs used inside the filter and AR stages.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import contextlib
+import time
+
+# ------------------------------------------------------------------------------
+# core scheduler
+# ------------------------------------------------------------------------------
+
+# participants are run in parallel, and the filter and AR stages can use more
+# than one core each. The scheduler shares the total core budget between the
+# participants that are still running, so that cores left idle as the batch
+# drains are handed to the stages that start after that.
+class CoreScheduler(object):
+    def __init__(self, manager, total_cores, parallel_jobs, num_participants):
+        self.total_cores = total_cores
+        self.parallel_jobs = parallel_jobs
+        self.lock = manager.Lock()
+        self.state = manager.dict(remaining = num_participants, allocated = 0)
+
+    def finish_job(self):
+        with self.lock:
+            self.state['remaining'] = self.state['remaining'] - 1
+
+    def acquire(self):
+        with self.lock:
+            # all workers are busy until fewer participants than workers remain
+            running = max(1, min(self.parallel_jobs, self.state['remaining']))
+            free = self.total_cores - self.state['allocated']
+
+            # fair share of the budget, but never less than one core
+            njobs = max(1, min(self.total_cores // running, free))
+            self.state['allocated'] = self.state['allocated'] + njobs
+        return(njobs, running)
+
+    def release(self, njobs):
+        with self.lock:
+            self.state['allocated'] = self.state['allocated'] - njobs
+
+@contextlib.contextmanager
+def inner_jobs(scheduler, allocation_log, stage):
+    start = time.time()
+
+    # stages run without a scheduler get a single core
+    if scheduler is None:
+        njobs, running = 1, 1
+    else:
+        njobs, running = scheduler.acquire()
+
+    try:
+        yield njobs
+    finally:
+        if scheduler is not None:
+            scheduler.release(njobs)
+        allocation_log.append({'stage': stage, 
+                               'n_jobs': njobs, 
+                               'running_participants': running, 
+                               'stage_time_in_minutes': round((time.time() - start) / 60, 2)})
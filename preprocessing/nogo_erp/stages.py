@@ -0,0 +1,688 @@
+# ==============================================================================
+# Preprocessing stages
+#
+# One function per stage, most based on MNE-Python. Each stage takes the
+# data of the previous one, or reads its checkpoint under tmp/ if called
+# without data.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import os
+import mne
+import collections
+import hashlib
+import json
+import numpy as np
+import scipy.fft
+
+from . import config
+from .config import file_splitter
+from .events import count_epochs, classify_events
+from .export import condition_weights, average_conditions, export_conditions, ConditionsWriter
+from .features import extract_features
+from .grand_average import add_evoked, evoked_file
+from .epochs_store import read_epochs_store, epoch_blocks
+from .errors import EventCountError
+from .ica_cleaning import clean_data
+from .runlog import log_record
+
+# ------------------------------------------------------------------------------
+# 1) prepare data function
+# ------------------------------------------------------------------------------
+
+def find_last_event(raw, stim_channel = 'STI 014', chunk_samples = 2**13):
+
+    # sample of the last event of a raw file that is not loaded, as found by
+    # mne.find_events(). The stim channel is read a block of samples at a
+    # time backwards from the end, until a block has an event onset, so only
+    # the end of the recording is read. Each block starts with the sample
+    # before it, so an onset on its first sample is found and a pulse that
+    # began in an earlier block is not taken as one
+    pick = raw.ch_names.index(stim_channel)
+    info = mne.pick_info(raw.info, [pick])
+    stop = len(raw.times)
+    while stop > 0:
+        start = max(0, stop - chunk_samples)
+        first = max(0, start - 1)
+        stim = raw.get_data(picks = [pick], start = first, stop = stop)
+        stim_raw = mne.io.RawArray(stim, info, first_samp = raw.first_samp + first, verbose = False)
+        events = mne.find_events(stim_raw, stim_channel = stim_channel, verbose = False)
+        events = events[events[:, 0] >= raw.first_samp + start]
+        if len(events) > 0:
+            return(events[-1][0])
+        stop = start
+    raise ValueError('No events found on ' + stim_channel)
+
+def prepare_data(participant):
+
+    file = config.data_inputdir + participant
+    participantid = file_splitter(file)
+    # the recording is opened without loading it, the last event is found
+    # from the end of the stim channel and only the samples up to the crop
+    # below are loaded, the rest of the session is never read
+    raw = mne.io.read_raw_egi(file, preload = False)
+    raw.set_montage(mne.channels.read_custom_montage(config.montage_file))
+
+    # crop a bit of unecessary data at the end of recording, keeps file size down
+    final_event = (find_last_event(raw) - raw.first_samp) / raw.info['sfreq']
+    if raw.times.max() > final_event + 1:
+      raw = raw.crop(0, final_event + 1)
+    else:
+      raw = raw.crop(0, raw.times.max())
+
+    # the EGI reader reads all channels of each sample, dropping a channel
+    # before loading only adds a copy, so it is dropped afterwards
+    raw.load_data()
+
+    # drop reference electrode (it's silent anyways)
+    raw = raw.drop_channels(['E129'])
+
+    if config.save_checkpoints:
+        raw.save(config.cropped_data_outputdir + participantid + '_cropped.raw.fif', 
+        overwrite = config.overwrite_opts)
+
+    return(raw)
+
+# ------------------------------------------------------------------------------
+# 2) filter data function
+# ------------------------------------------------------------------------------
+
+def filter_bands(raw, bands, njobs = 1):
+
+    # filters all EEG channels with several FIR bandpass filters in one pass,
+    # the signal is transformed once and multiplied with the spectrum of each
+    # filter. Kernels, edge padding and delay compensation are the same as
+    # in raw.filter(), so the result is the same up to floating point error.
+    # The first band is written to raw in place, the others are returned as
+    # new Raw objects.
+    picks = mne.pick_types(raw.info, eeg = True)
+    sfreq = raw.info['sfreq']
+    n_times = len(raw.times)
+
+    kernels = []
+    for l_freq, h_freq in bands:
+        kernels.append(mne.filter.create_filter(None, sfreq, l_freq, h_freq, 
+                                                filter_length = 'auto', 
+                                                l_trans_bandwidth = 'auto', 
+                                                h_trans_bandwidth = 'auto', 
+                                                method = config.filter_method, 
+                                                iir_params = None, 
+                                                phase = config.filter_phase, 
+                                                fir_window = config.fir_window, 
+                                                fir_design = config.fir_design, 
+                                                verbose = None))
+
+    # pad for the longest kernel, shorter kernels never reach past their own padding
+    n_h = max(len(h) for h in kernels)
+    n_edge = max(min(n_h, n_times) - 1, 0)
+    n_fft = scipy.fft.next_fast_len(n_times + 2 * n_edge + n_h - 1, real = True)
+    kernel_spectra = [scipy.fft.rfft(h, n_fft) for h in kernels]
+
+    outputs = [None] + [raw.get_data() for band in bands[1:]]
+
+    # a few channels at a time keeps the spectra small
+    block_size = 8
+    for start in range(0, len(picks), block_size):
+        block = picks[start:start + block_size]
+        x = raw._data[block]
+
+        # same 'reflect_limited' edge padding as raw.filter()
+        x_ext = np.concatenate([2 * x[:, :1] - x[:, n_edge:0:-1], 
+                                x, 
+                                2 * x[:, -1:] - x[:, -2:-n_edge - 2:-1]], axis = 1)
+        spectrum = scipy.fft.rfft(x_ext, n_fft, axis = 1, workers = njobs)
+        del x_ext
+
+        for i, h in enumerate(kernels):
+            y = scipy.fft.irfft(spectrum * kernel_spectra[i], n_fft, axis = 1, workers = njobs)
+            offset = n_edge + (len(h) - 1) // 2
+            if i == 0:
+                raw._data[block] = y[:, offset:offset + n_times]
+            else:
+                outputs[i][block] = y[:, offset:offset + n_times]
+
+    raw.info['highpass'], raw.info['lowpass'] = bands[0]
+    filtered = [raw]
+
+    for i in range(1, len(bands)):
+        info = raw.info.copy()
+        info['highpass'], info['lowpass'] = bands[i]
+        raw_band = mne.io.RawArray(outputs[i], info, first_samp = raw.first_samp, verbose = False)
+        raw_band.set_annotations(raw.annotations)
+        filtered.append(raw_band)
+
+    return(filtered)
+
+def decimation_factor(info, sfreq):
+
+    # the factor k to decimate epochs to sfreq by keeping every k-th sample,
+    # or 1 if that is not safe: the rate must be an integer multiple of
+    # sfreq and the transition band of the lowpass filter must end below
+    # the new Nyquist frequency
+    k = int(round(info['sfreq'] / sfreq))
+    h_freq = info['lowpass']
+    h_trans_bandwidth = min(max(0.25 * h_freq, 2.), info['sfreq'] / 2. - h_freq) # as h_trans_bandwidth = 'auto'
+    if k < 2 or k * sfreq != info['sfreq'] or h_freq + h_trans_bandwidth > sfreq / 2.:
+        return(1)
+    return(k)
+
+def filter_data(participant, raw = None, njobs = 1):
+    file = config.data_inputdir + participant
+    participantid = file_splitter(file)
+
+    # read the checkpoint only if data wasn't handed over from the previous stage
+    if raw is None:
+        raw = mne.io.read_raw_fif(config.cropped_data_outputdir + participantid + '_cropped.raw.fif', preload = True)
+
+    with open(config.bad_channel_inputdir + participantid + '_bad_channels', 'r') as f:
+        bad_channels = [line.rstrip('\n') for line in f]
+
+    # the data used for ICA is only needed for fitting ICA solutions offline,
+    # so it is only created when checkpoints are saved
+    if config.dual_band_filter:
+
+        # interpolation and re-referencing are linear combinations of channels
+        # and filtering is linear in time, so they can be done once, before
+        # filtering, instead of once for each filtered copy
+        raw.info['bads'] = bad_channels
+
+        if(len(bad_channels) > 0):
+            raw.interpolate_bads(reset_bads = True, mode = 'accurate')
+
+        raw.set_eeg_reference()
+
+        bands = [(config.raw_filter_highpass, config.raw_filter_lowpass)]
+        if config.save_checkpoints:
+            bands.append((config.raw_ica_filter_highpass, config.raw_ica_filter_lowpass))
+
+        filtered = filter_bands(raw, bands, njobs)
+        raw = filtered[0]
+
+        if config.save_checkpoints:
+            raw_ica = filtered[1]
+
+    else:
+        if config.save_checkpoints:
+            raw_ica = raw.copy()
+
+        # separate filters for raw data and data used for ICA
+        raw.filter(config.raw_filter_highpass, 
+                   config.raw_filter_lowpass, 
+                   filter_length = 'auto', 
+                   l_trans_bandwidth = 'auto', 
+                   h_trans_bandwidth = 'auto', 
+                   n_jobs = njobs, 
+                   method = config.filter_method, 
+                   iir_params = None, 
+                   phase = config.filter_phase, 
+                   fir_window = config.fir_window, 
+                   verbose = None, 
+                   fir_design = config.fir_design)
+
+        if config.save_checkpoints:
+            raw_ica.filter(config.raw_ica_filter_highpass, 
+                           config.raw_ica_filter_lowpass, 
+                           filter_length = 'auto', 
+                           l_trans_bandwidth = 'auto', 
+                           h_trans_bandwidth = 'auto', 
+                           n_jobs = njobs, 
+                           method = config.filter_method, 
+                           iir_params = None, 
+                           phase = config.filter_phase, 
+                           fir_window = config.fir_window, 
+                           verbose = None, 
+                           fir_design = config.fir_design)
+
+        raw.info['bads'] = bad_channels
+
+        if(len(bad_channels) > 0):
+            raw.interpolate_bads(reset_bads = True, mode = 'accurate')
+
+        raw.set_eeg_reference()
+
+        if config.save_checkpoints:
+            raw_ica.info['bads'] = bad_channels
+
+            if(len(bad_channels) > 0):
+                raw_ica.interpolate_bads(reset_bads = True, mode = 'accurate')
+
+            raw_ica.set_eeg_reference()
+
+    if config.save_checkpoints:
+        raw.save(config.filtered_data_outputdir + participantid + '_filtered.raw.fif', 
+                 overwrite = config.overwrite_opts)
+
+        raw_ica.save(config.filtered_data_outputdir + participantid + '_filtered_ica.raw.fif', 
+                 overwrite = config.overwrite_opts)
+
+    filter_log = {
+     'ID': participantid, 
+     'raw_highpass': config.raw_filter_highpass, 
+     'raw_lowpass': config.raw_filter_lowpass, 
+     'raw_ica_highpass': config.raw_ica_filter_highpass, 
+     'raw_ica_lowpass': config.raw_ica_filter_lowpass, 
+     'filter_method': config.filter_method, 
+     'filter_phase': config.filter_phase, 
+     'fir_window': config.fir_window, 
+     'fir_design': config.fir_design, 
+     'num_bad_channels_interpolated': len(bad_channels), 
+    }
+
+    log_record('filter', participantid, filter_log)
+
+    return(raw)
+
+# ------------------------------------------------------------------------------
+# 3) ICA function
+# ------------------------------------------------------------------------------
+
+def apply_ica(participant, raw = None):
+    file = config.data_inputdir + participant
+    participantid = file_splitter(file)
+
+    if raw is None:
+        raw = mne.io.read_raw_fif(config.filtered_data_outputdir + participantid + '_filtered.raw.fif', 
+                                  preload = True)
+
+    # ICA is applied in place, the filtered data is not used after this stage
+    raw_clean = raw
+    num_excluded = clean_data(participantid, raw_clean)
+    #ica_plot = ica.plot_overlay(raw, ica.exclude, start = 0)
+    #ica_plot.savefig(plot_outputdir + participantid + '_before_and_after_ICA' + '.png')
+
+    if config.save_checkpoints:
+        raw_clean.save(config.cleaned_data_outputdir + participantid + '_cleaned.raw.fif', 
+                 overwrite = config.overwrite_opts)
+
+    ica_log = {
+     'ID': participantid, 
+     'num_icas_zeroed_out': num_excluded
+     }
+
+    log_record('ica', participantid, ica_log)
+
+    return(raw_clean)
+
+# ------------------------------------------------------------------------------
+# 4) epoch and resample function
+# ------------------------------------------------------------------------------
+
+def epoch_data(participant, raw_clean = None):
+    file = config.data_inputdir + participant
+    participantid = file_splitter(file)
+
+    # lazy epoching reads the checkpoint without loading it, events are found
+    # from the stim channel and only the samples of the epochs are read. If
+    # there is no ICA cleaned checkpoint the filtered one is epoched and the
+    # ICA is applied to the epochs, both are linear, so the result is the
+    # same as epoching the cleaned data
+    ica_pending = False
+    if raw_clean is None:
+        cleaned_file = config.cleaned_data_outputdir + participantid + '_cleaned.raw.fif'
+        if config.lazy_epoching and not os.path.isfile(cleaned_file):
+            raw_clean = mne.io.read_raw_fif(config.filtered_data_outputdir + participantid + '_filtered.raw.fif', preload = False)
+            ica_pending = True
+        else:
+            raw_clean = mne.io.read_raw_fif(cleaned_file, preload = not config.lazy_epoching)
+
+    # reject quiet channels < 5 mV
+    flat = dict(eeg = 5e-6)
+
+    # get event IDs
+    events = mne.find_events(raw_clean, stim_channel = 'STI 014', verbose = None)
+
+    # some subjects have different event IDs for different stims, 
+    # so we'll need to extract and count occurences
+    num_events = events[:, 2]
+    counted_events = collections.Counter(num_events)
+
+    # we know that the order of counts should be:
+    # (1) responses, 300 + usually
+    # (2) go trials, 274 (although some have one more due to starting the recording
+    # before participants finished practice trials)
+    # (3) nogo trials, always 52
+    # (4) pause, always 1
+    ordered_events = counted_events.most_common()
+
+    if len(ordered_events) == 4:
+        response = ordered_events[0][0]
+        go = ordered_events[1][0]
+        nogo = ordered_events[2][0]
+        pause = ordered_events[3][0]
+
+        event_id = {'Response': response, 
+                  'Go': go, 
+                  'NoGo': nogo, 
+                  'Pause': pause}
+
+    elif len(ordered_events) == 3:
+        response = ordered_events[0][0]
+        go = ordered_events[1][0]
+        nogo = ordered_events[2][0]
+
+        event_id = {'Response': response, 
+                    'Go': go, 
+                    'NoGo': nogo}
+
+    else:
+        raise EventCountError(participantid, 'epoch', 'Error occured during event counting, found ' + str(len(ordered_events)) + ' event types')
+
+    # relabel go/nogo/response events into correct and incorrect trials,
+    # conditions without any trials are left out of event_id
+    events, event_id, event_counts = classify_events(events, event_id, config.event_rules)
+
+    picks = mne.pick_types(raw_clean.info, 
+                         eeg = True, 
+                         exclude = 'bads')
+
+    raw_clean.info['projs'] = list()
+
+    # the epochs can be decimated to target_sfreq as they are read, the
+    # events are found at the original rate, so the onsets are exact.
+    # Epochs resampled from 1000 Hz end one sample before tmax, decimated
+    # epochs are cut the same way so the times are the same
+    decim = decimation_factor(raw_clean.info, config.target_sfreq) if config.decimate_epochs else 1
+    tmax = config.tmax
+    if decim > 1:
+        tmax = config.tmax - 1. / config.target_sfreq
+
+    epochs = mne.Epochs(raw_clean, events, event_id, config.tmin, tmax, 
+                        picks = picks, 
+                        baseline = config.baseline, 
+                        flat = None if ica_pending else flat, 
+                        preload = True, 
+                        decim = decim, 
+                        verbose = None, 
+                        detrend = None)
+
+    # quiet channels are rejected after cleaning, as they would have been
+    if ica_pending:
+        num_excluded = clean_data(participantid, epochs, offset = False)
+        epochs.drop_bad(flat = flat)
+
+        ica_log = {
+         'ID': participantid, 
+         'num_icas_zeroed_out': num_excluded
+         }
+
+        log_record('ica', participantid, ica_log)
+
+    # already at the target rate if the epochs were decimated
+    if epochs.info['sfreq'] != config.target_sfreq:
+        epochs.resample(config.target_sfreq, npad = 'auto')
+
+    if config.save_checkpoints:
+        epochs.save(config.epoched_data_outputdir + participantid + '-epo.fif', 
+                    split_size = '2GB', 
+                    fmt = 'double', 
+                    verbose = None, 
+                    overwrite = config.overwrite_opts)
+
+    epoch_log = {
+     'ID': participantid, 
+     'num_correct_go_trials': event_counts['gocorr'], 
+     'num_correct_nogo_trials': event_counts['nogocorr'], 
+     'num_incorrect_nogo_trials': event_counts['nogoincorr'], 
+     'decimation_factor': decim
+     }
+
+    log_record('epoch', participantid, epoch_log)
+
+    return(epochs)
+
+# ------------------------------------------------------------------------------
+# 5) autoreject function
+# ------------------------------------------------------------------------------
+
+def epochs_hash(epochs):
+    sha = hashlib.sha256()
+    sha.update(np.ascontiguousarray(epochs.get_data()).tobytes())
+    sha.update(np.ascontiguousarray(epochs.events).tobytes())
+    sha.update(json.dumps([epochs.ch_names, epochs.info['sfreq'], epochs.tmin]).encode('utf-8'))
+    return(sha.hexdigest())
+
+def interpolated_channels(participantid):
+
+    # the bad channels interpolated by filter_data, the epochs keep all
+    # channels, so these tell apart models fitted on different channel data
+    with open(config.bad_channel_inputdir + participantid + '_bad_channels', 'r') as f:
+        return(sorted(line.rstrip('\n') for line in f))
+
+def read_autoreject_model(participantid, epochs, ar_params, warm_start):
+
+    # returns the AutoReject model fitted on exactly these epochs with the same
+    # parameters and interpolated channels, or with warm_start, the last model
+    # fitted for this participant with the same parameters and interpolated
+    # channels. Returns None if there is no usable model.
+    from autoreject import read_auto_reject
+
+    model_file = config.autoreject_model_outputdir + participantid + '-ar.hdf5'
+    model_info_file = config.autoreject_model_outputdir + participantid + '-ar.json'
+
+    if not os.path.isfile(model_file) or not os.path.isfile(model_info_file):
+        return(None, 'fitted')
+
+    with open(model_info_file, 'r') as f:
+        model_info = json.load(f)
+
+    # thresholds of interpolated channels do not carry over to the measured
+    # ones, so a model is refitted once the bad channels change
+    if model_info['params'] != ar_params or model_info.get('interpolated_channels') != interpolated_channels(participantid):
+        return(None, 'fitted')
+
+    if model_info['epochs_hash'] == epochs_hash(epochs):
+        return(read_auto_reject(model_file), 'cached')
+
+    # autoreject can't seed its Bayesian optimization, so a warm start reuses
+    # the cached thresholds, consensus and n_interpolate as they are
+    if warm_start:
+        return(read_auto_reject(model_file), 'warm')
+
+    return(None, 'fitted')
+
+def write_autoreject_model(participantid, epochs, ar_params, ar):
+    ar.save(config.autoreject_model_outputdir + participantid + '-ar.hdf5', overwrite = True)
+
+    model_info = {
+     'params': ar_params, 
+     'epochs_hash': epochs_hash(epochs), 
+     'interpolated_channels': interpolated_channels(participantid)
+    }
+
+    with open(config.autoreject_model_outputdir + participantid + '-ar.json', 'w') as f:
+        json.dump(model_info, f)
+
+def autoreject_data(participant, njobs, ar_threshold, autoreject_cv, autoreject_random_state, epochs = None):
+
+    # autoreject pulls in scikit-learn, so it is only imported when used
+    import autoreject
+    from autoreject import AutoReject
+
+    file = config.data_inputdir + participant
+    participantid = file_splitter(file)
+
+    if epochs is None:
+        epochs = mne.read_epochs(config.epoched_data_outputdir + participantid + '-epo.fif', 
+                                proj = True, 
+                                preload = True, 
+                                verbose = None)
+
+    ar_params = {
+     'thresh_method': 'bayesian_optimization', 
+     'cv': autoreject_cv, 
+     'random_state': autoreject_random_state, 
+     'autoreject_version': autoreject.__version__
+    }
+
+    # reuse the fitted model from an earlier run if there is one, the reject
+    # log is recomputed by transform() from the model
+    ar = None
+    ar_model = 'fitted'
+    if config.reuse_autoreject_model:
+        ar, ar_model = read_autoreject_model(participantid, epochs, ar_params, config.autoreject_warm_start)
+
+    if ar is None:
+        ar = AutoReject(thresh_method = 'bayesian_optimization', 
+        cv = autoreject_cv, 
+        random_state = autoreject_random_state, 
+        n_jobs = njobs, 
+        verbose = False)
+
+        ar.fit(epochs)
+        write_autoreject_model(participantid, epochs, ar_params, ar)
+
+    ar.n_jobs = njobs
+    epochs_clean, reject_log = ar.transform(epochs, return_log = True)
+
+    # conditions without any epochs are counted as zero
+    conditions = ['gocorr', 'nogocorr', 'nogoincorr']
+    counts = count_epochs(epochs, conditions)
+    num_go_correct = counts['gocorr']
+    num_nogo_correct = counts['nogocorr']
+    num_nogo_incorrect = counts['nogoincorr']
+
+    # look at number of epochs after autoreject
+    counts_ar = count_epochs(epochs_clean, conditions)
+    num_go_correct_ar = counts_ar['gocorr']
+    num_nogo_correct_ar = counts_ar['nogocorr']
+    num_nogo_incorrect_ar = counts_ar['nogoincorr']
+
+    # percent incorrect nogo trials left after autoreject
+    if num_nogo_incorrect == 0 and num_nogo_incorrect_ar == 0:
+        percent_incorr_nogo_ar = 0
+    else:
+        percent_incorr_nogo_ar = round(num_nogo_incorrect_ar / num_nogo_incorrect * 100, 2)
+
+    # how many individual channels per epoch were good, bad or interpolated?
+    rejected_channels = np.concatenate(reject_log.labels)
+    total = len(rejected_channels)
+    bad = np.count_nonzero(rejected_channels == 1)
+    interpolated = np.count_nonzero(rejected_channels == 2)
+
+	# optional plotting
+    # plt.ioff()
+    # fig, ax = plt.subplots(2, 1)
+    # fig.tight_layout()
+    # ylim = dict(eeg = (-15, 15))
+    # epochs.average().plot(ylim = ylim, spatial_colors = True, axes = ax[0])
+    # epochs_clean.average().plot(ylim = ylim, spatial_colors = True, axes = ax[1])
+    # fig.savefig(plot_outputdir + participantid + '_before_after_AR' + '.png')
+    # plt.close(fig)
+
+    # save cleaned epoched data only if number of correct nogo trials left after
+    # AR exceeds a certain threshold, the threshold itself is applied by the
+    # caller so that cached AR results don't depend on it
+    if num_nogo_correct_ar >= ar_threshold and config.save_checkpoints:
+        epochs_clean.save(config.cleaned_epoched_data_outputdir + participantid + '_cleaned-epo.fif', 
+                split_size = '2GB', fmt = 'double', 
+                verbose = None, overwrite = config.overwrite_opts)
+
+    autoreject_log = {
+     'ID': participantid, 
+     'num_correct_go_trials_after_ar': num_go_correct_ar, 
+     'perc_correct_go_trials_after_ar': num_go_correct_ar / num_go_correct * 100, 
+     'num_correct_nogo_trials_after_ar': num_nogo_correct_ar, 
+     'perc_correct_nogo_trials_after_ar': num_nogo_correct_ar / num_nogo_correct * 100, 
+     'num_incorrect_nogo_trials_after_ar': num_nogo_incorrect_ar, 
+     'perc_incorrect_nogo_trials_after_ar': percent_incorr_nogo_ar, 
+     'perc_bad_and_rejected_channels': bad / total * 100, 
+     'perc_bad_and_interpolated_channels': interpolated / total * 100, 
+     'autoreject_model': ar_model, 
+    }
+
+    log_record('autoreject', participantid, autoreject_log)
+
+    return(epochs_clean)
+
+# ------------------------------------------------------------------------------
+# 6) save data function
+# ------------------------------------------------------------------------------
+
+def save_data(participant, epochs_clean = None):
+    file = config.data_inputdir + participant
+    participantid = file_splitter(file)
+
+    # only load data if ar_threshold was satisfied, the epochs store is opened
+    # as a memory map if there is one. Returns the names of the evoked data
+    # that were saved
+    if epochs_clean is None and config.epochs_store and os.path.isfile(config.epochs_store_outputdir + participantid + '_cleaned.npy'):
+        epochs_clean = read_epochs_store(config.epochs_store_outputdir + participantid + '_cleaned')
+        if count_epochs(epochs_clean, ['nogocorr'])['nogocorr'] < config.ar_threshold:
+            return([])
+
+    if epochs_clean is None and os.path.isfile(config.cleaned_epoched_data_outputdir + participantid + '_cleaned-epo.fif'):
+        epochs_clean = mne.read_epochs(config.cleaned_epoched_data_outputdir + participantid + '_cleaned-epo.fif', 
+                                proj = True, 
+                                preload = True, 
+                                verbose = None)
+
+    if epochs_clean is not None:
+
+        # the epochs of all exported conditions are read once, a block at a
+        # time, conditions without epochs are left out. Each block is written
+        # to the single-trial export (raw) and added to all averages and
+        # difference waves with one matrix multiply
+        counts = count_epochs(epochs_clean, config.export_conditions)
+        conditions = [condition for condition in config.export_conditions if counts[condition] > 0]
+        epochs_export = epochs_clean[conditions]
+
+        condition_names = {code: name for name, code in epochs_export.event_id.items()}
+        epoch_conditions = [condition_names[code] for code in epochs_export.events[:, 2]]
+        names, weights, naves = condition_weights(epoch_conditions, conditions, config.difference_waves)
+
+        averages = np.zeros((len(names), len(epochs_export.ch_names), len(epochs_export.times)))
+        raw_writer = ConditionsWriter(epochs_export.times, epochs_export.ch_names, 
+                                      config.raw_averaged_data_outputdir + participantid + '_conditions_raw', 
+                                      config.export_format, len(epochs_export))
+        for start, block in epoch_blocks(epochs_export):
+            stop = start + len(block)
+            averages += average_conditions(block, weights[:, start:stop])
+            raw_writer.write(block, epoch_conditions[start:stop], epochs_export.selection[start:stop])
+        raw_writer.close()
+
+        # save averaged evoked data, one file per condition, and add it to the
+        # grand average of the group, replacing the evoked data of an earlier
+        # run. That is read before it is overwritten, the new file is written
+        # under a temporary name and renamed over it, and the grand average
+        # is only updated once the file is in place. What is added is read
+        # back from the file, as saved in float32, so a re-run subtracts
+        # exactly what was added and the sums do not drift
+        for name, average, nave in zip(names, averages, naves):
+            evoked = mne.EvokedArray(average, epochs_export.info, tmin = epochs_export.times[0], 
+                                     comment = name, nave = nave, verbose = False)
+            fname = evoked_file(participantid, name)
+            previous = None
+            if os.path.isfile(fname):
+                previous = mne.read_evokeds(fname, condition = name, proj = True, verbose = None).data
+            tmp_file = fname[:-len('-ave.fif')] + '.tmp.' + str(os.getpid()) + '-ave.fif'
+            evoked.save(tmp_file)
+            os.replace(tmp_file, fname)
+            evoked = mne.read_evokeds(fname, condition = name, proj = True, verbose = None)
+            add_evoked(participantid, name, evoked, previous = previous)
+
+        # save for import to R, as csv or in one of the binary formats, all
+        # conditions in one file with a condition column, the non-averaged
+        # (raw) epochs are already written above
+
+        # averaged
+        export_conditions(averages, epochs_export.times, epochs_export.ch_names, names, 
+                          config.averaged_data_outputdir + participantid + '_conditions', config.export_format)
+        return(names)
+
+    return([])
+
+# ------------------------------------------------------------------------------
+# 7) feature extraction function
+# ------------------------------------------------------------------------------
+
+def feature_data(participant, epochs_clean):
+    file = config.data_inputdir + participant
+    participantid = file_splitter(file)
+
+    # ROI amplitudes and latencies per trial and for the average, in µV and ms
+    features = extract_features(epochs_clean, config.roi_channels, config.feature_windows, config.feature_conditions)
+    features.insert(0, 'ID', participantid)
+    return(features)
@@ -0,0 +1,182 @@
+# ==============================================================================
+# Topomap rendering
+#
+# The interpolation from the sensors to the image grid is linear in the
+# data, so it is computed once per montage as a grid x channels matrix and
+# applied to any number of maps (groups, times, conditions) with a single
+# matrix multiply. The maps are then drawn into one grid figure, or into
+# one file each by updating the same figure. They look like plot_topomap
+# with res = 32, extrapolate = 'box' and contours = 6, except that the
+# head circle is drawn just outside the outermost sensors rather than at
+# the sphere MNE fits to the montage, so the map fills the head outline.
+# ==============================================================================
+
+# ------------------------------------------------------------------------------
+# import modules
+# ------------------------------------------------------------------------------
+
+import numpy as np
+import scipy.interpolate
+import scipy.spatial
+
+# ------------------------------------------------------------------------------
+# interpolation
+# ------------------------------------------------------------------------------
+
+def sensor_positions(info):
+
+    # azimuthal equidistant projection of the 3D sensor positions, the same
+    # projection as mne.viz.plot_topomap, the vertex is at the origin and
+    # sensors on the level of the nasion and inion at a radius of pi / 2
+    loc = np.array([ch['loc'][:3] for ch in info['chs']])
+    radius = np.linalg.norm(loc, axis = 1)
+    polar = np.arccos(np.clip(loc[:, 2] / radius, -1, 1))
+    azimuth = np.arctan2(loc[:, 1], loc[:, 0])
+    return(np.column_stack([polar * np.cos(azimuth), polar * np.sin(azimuth)]))
+
+def interpolation_matrix(pos, grid, extrapolate_radius):
+
+    # the interpolator is fitted to the identity, one column per sensor, so
+    # each column of the result is the map of a unit value at that sensor.
+    # The box around the head is filled by extra points that copy their
+    # nearest sensor, as extrapolate = 'box' does in plot_topomap
+    n_channels = len(pos)
+    box = np.linspace(-extrapolate_radius, extrapolate_radius, 9)
+    outer = np.vstack([np.column_stack([box, np.full(9, -extrapolate_radius)]),
+                       np.column_stack([box, np.full(9, extrapolate_radius)]),
+                       np.column_stack([np.full(7, -extrapolate_radius), box[1:-1]]),
+                       np.column_stack([np.full(7, extrapolate_radius), box[1:-1]])])
+    nearest = scipy.spatial.cKDTree(pos).query(outer)[1]
+
+    points = np.vstack([pos, outer])
+    values = np.vstack([np.eye(n_channels), np.eye(n_channels)[nearest]])
+    interpolator = scipy.interpolate.CloughTocher2DInterpolator(points, values)
+    return(np.nan_to_num(interpolator(grid)))
+
+# outline of the nose and the right ear in units of the head radius, as
+# drawn by mne.viz.plot_topomap
+nose_x = np.array([-0.2094, 0., 0.2094])
+nose_y = np.array([0.9778, 1.15, 0.9778])
+ear_x = np.array([.497, .510, .518, .5299, .5419, .54, .547, .532, .510, .489]) * 2
+ear_y = np.array([.0555, .0775, .0783, .0746, .0555, -.0055, -.0932, -.1313, -.1384, -.1199]) * 2
+
+class TopomapRenderer(object):
+
+    # info has the channels of the data, mask_channels are marked with white
+    # circles, res is the number of pixels along each side of a map
+    def __init__(self, info, res = 32, mask_channels = None):
+        self.ch_names = info['ch_names']
+        self.pos = sensor_positions(info)
+        self.head_radius = np.abs(self.pos).max() * 1.05
+        self.res = res
+
+        axis = np.linspace(-self.head_radius, self.head_radius, res)
+        grid_x, grid_y = np.meshgrid(axis, axis)
+        grid = np.column_stack([grid_x.ravel(), grid_y.ravel()])
+        self.extent = (-self.head_radius, self.head_radius, -self.head_radius, self.head_radius)
+        self.matrix = interpolation_matrix(self.pos, grid, self.head_radius * 1.2)
+
+        mask_channels = [] if mask_channels is None else mask_channels
+        self.mask_pos = self.pos[[self.ch_names.index(ch) for ch in mask_channels]]
+
+    def maps(self, data):
+
+        # data is channels x maps, returns maps x res x res, the square
+        # around the head, draw() clips it to the head outline
+        images = (self.matrix @ data).T
+        return(images.reshape(-1, self.res, self.res))
+
+    def draw(self, ax, image, vmin, vmax, cmap = 'Spectral_r', contours = 6):
+        import matplotlib.patches as patches
+
+        # the image and contours are clipped to the head circle, as in
+        # plot_topomap, rather than masked pixel by pixel
+        r = self.head_radius
+        head = patches.Circle((0, 0), r, fill = False, color = 'k', linewidth = 1)
+        ax.add_patch(head)
+
+        mappable = ax.imshow(image, origin = 'lower', extent = self.extent, cmap = cmap,
+                             vmin = vmin, vmax = vmax, interpolation = 'bilinear')
+        mappable.set_clip_path(head)
+        if contours > 0 and image.max() > image.min():
+            levels = np.linspace(vmin, vmax, contours + 2)[1:-1]
+            axis = np.linspace(-self.head_radius, self.head_radius, self.res)
+            contour_set = ax.contour(axis, axis, image, levels = levels, colors = 'k', linewidths = 0.5)
+            contour_set.set_clip_path(head)
+
+        # nose and ears, the same shapes as plot_topomap
+        ax.plot(nose_x * r, nose_y * r, color = 'k', linewidth = 1)
+        ax.plot(ear_x * r, ear_y * r, color = 'k', linewidth = 1)
+        ax.plot(-ear_x * r, ear_y * r, color = 'k', linewidth = 1)
+        if len(self.mask_pos) > 0:
+            ax.plot(self.mask_pos[:, 0], self.mask_pos[:, 1], 'o', markerfacecolor = 'w',
+                    markeredgecolor = 'k', linewidth = 0, markersize = 4)
+        ax.set_xlim(-1.2 * r, 1.2 * r)
+        ax.set_ylim(-1.2 * r, 1.2 * r)
+        ax.set_aspect('equal')
+        ax.axis('off')
+        return(mappable)
+
+# ------------------------------------------------------------------------------
+# slices and figures
+# ------------------------------------------------------------------------------
+
+def time_slices(means, times, slice_times):
+
+    # means is a list of channels x times arrays (groups or conditions),
+    # returns channels x (len(means) * len(slice_times)), ordered by mean
+    # and then by time, at the samples closest to slice_times (in s)
+    samples = [int(np.argmin(np.abs(times - t))) for t in slice_times]
+    return(np.hstack([mean[:, samples] for mean in means]))
+
+def plot_topomap_grid(renderer, data, n_rows, n_cols, vlims, row_labels = None, col_labels = None,
+                      figsize = None, cmap = 'Spectral_r', contours = 6, scale = 1e6, unit = 'µV'):
+
+    # data is channels x (n_rows * n_cols) in row order, vlims is one
+    # (vmin, vmax) for all maps or one per column
+    import matplotlib.pyplot as plt
+
+    images = renderer.maps(data * scale)
+    vlims = [vlims] * n_cols if isinstance(vlims[0], (int, float)) else vlims
+    figsize = (1.4 * n_cols + 0.8, 1.4 * n_rows + 0.4) if figsize is None else figsize
+    fig, axes = plt.subplots(n_rows, n_cols, figsize = figsize, squeeze = False)
+
+    for i, image in enumerate(images):
+        row, col = divmod(i, n_cols)
+        ax = axes[row, col]
+        mappable = renderer.draw(ax, image, vlims[col][0], vlims[col][1], cmap, contours)
+        if row == 0 and col_labels is not None:
+            ax.set_title(col_labels[col], fontsize = 8)
+        if col == 0 and row_labels is not None:
+            ax.text(-1.3 * renderer.head_radius, 0, row_labels[row], rotation = 90,
+                    ha = 'right', va = 'center', fontsize = 8)
+
+    # one colorbar per column if the limits differ, otherwise one for the grid
+    if all(vlim == vlims[0] for vlim in vlims):
+        fig.colorbar(mappable, ax = axes.ravel().tolist(), shrink = 0.6, label = unit)
+    else:
+        for col in range(n_cols):
+            fig.colorbar(axes[0, col].images[0], ax = axes[:, col].tolist(), shrink = 0.6,
+                         orientation = 'horizontal', label = unit)
+    return(fig)
+
+def save_topomaps(renderer, data, fnames, vlims, figsize = (2, 2), cmap = 'Spectral_r',
+                  contours = 6, scale = 1e6, unit = 'µV', dpi = 300):
+
+    # one file per map, data is channels x len(fnames), vlims is one
+    # (vmin, vmax) for all maps or one per map. The interpolation is done for
+    # all maps at once and the same figure is redrawn for each file
+    import matplotlib.pyplot as plt
+
+    images = renderer.maps(data * scale)
+    vlims = [vlims] * len(fnames) if isinstance(vlims[0], (int, float)) else vlims
+    fig, ax = plt.subplots(figsize = figsize)
+
+    for image, vlim, fname in zip(images, vlims, fnames):
+        ax.clear()
+        mappable = renderer.draw(ax, image, vlim[0], vlim[1], cmap, contours)
+        colorbar = fig.colorbar(mappable, ax = ax, shrink = 0.8, label = unit)
+        fig.savefig(fname, dpi = dpi, bbox_inches = 'tight', pad_inches = 0)
+        colorbar.remove()
+
+    plt.close(fig)
@@ -5,12 +5,14 @@ start=`date +%s`
 
 # create directories
 DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
-mkdir -p $DIR/preprocess/tmp/{cropped,filtered,cleaned,epoched,cleaned_epoched,evoked}
+mkdir -p $DIR/preprocess/tmp/{cropped,filtered,cleaned,epoched,cleaned_epoched,evoked,cache,autoreject,epochs_store}
 mkdir -p $DIR/preprocess/output/{data,raw_data,logs,plots}
 
 # preprocess and plot
 python3 $DIR/preprocess/01_preprocess.py
 python3 $DIR/preprocess/02_topoplot.py
+python3 $DIR/preprocess/03_reliability.py
+python3 $DIR/preprocess/04_cluster_test.py
 
 # stop timer
 end=`date +%s`